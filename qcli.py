@@ -4,15 +4,34 @@
 import os
 import sys
 import fire
+import glob
 import json
 import time
+import socket
+import shutil
 import zipfile
 import tempfile
 import datetime
-from subprocess import run, Popen, PIPE
+import traceback
+import contextlib
+import collections
+import urllib.error
+import urllib.request
+import numpy as np
+import pandas as pd
+from subprocess import run, Popen, PIPE, DEVNULL
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
 from src.lib.mea import Mea
 from src.lib.qccalc import Qccalc
 from src.lib.qcplot import Qcplot
+from src.lib.qcstate import Qcstate
+from src.lib.bundle import Bundle
+from src.lib.scheduler import Scheduler
+from src.lib.resultcache import Resultcache
+from src.lib.generator import Generator
+from src.lib.profiler import Profiler
+from src.lib.qcserver import Qcserver
 
 class Qcli(object):
     """ CLI to the mzQuality
@@ -30,23 +49,83 @@ class Qcli(object):
         - rsd internal standard(s)
         - plot information compound(s)
         - export results as samples vs. compounds
+        - run all of the above on one measurements file
+        - run all of the above on each study (measurements file) of a manifest
+        - add a batch to the QC state of a study
+        - generate a synthetic measurements file
+        - serve the methods above as a local HTTP/JSON service
+
+        Use --cache to keep a binary copy of each measurements file next to it,
+        later runs on the same (unchanged) file then skip parsing the text file.
+        Use --downcast to store batch, order and injection in small integer types.
+        Use --profile to trace the wall time, CPU time, peak RSS and rows of each stage as JSON lines,
+        to stderr or to the file given (--profile=trace.jsonl). The CPU time is that of the thread of
+        the stage, the peak RSS is that of the whole process (use run-all --threads=1 to attribute it
+        to single stages). Use --profile-stats=stats.prof to also write the cProfile stats of the
+        slowest stage.
     """
 
-    def summary(self, mea_file):
-        """ Report a summary of the measurements ... """
+    def __init__(self, cache=False, downcast=False, profile=False, profile_stats='', result_cache='', result_cache_size=1024):
+        self.cache = cache
+        self.downcast = downcast
+        self.profiler = None
 
-        try:
-            # load measurements file
-            mea = Mea(mea_file)
-
-            # build summary dict
-            summary = {
-                'batches': mea.get_batches().tolist(),
-                'samples': mea.get_samples().tolist(),
-                'compounds': mea.get_compounds().tolist()
+        # results of earlier runs are reused when a result cache (directory) is set, limited in size (MB)
+        self.result_cache = None
+        if result_cache:
+            self.result_cache = Resultcache(cache_dir=result_cache, size_limit=result_cache_size, sources=[os.path.abspath(__file__)])
+
+        # the stages are only instrumented when profiling
+        if profile or profile_stats:
+            trace_file = profile if isinstance(profile, str) else ''
+            self.profiler = Profiler(trace_file=trace_file, stats_file=profile_stats).install()
+
+    def _load_mea(self, mea_file, columns=None):
+        """ Load a measurements file, using the binary cache when enabled, optionally only the columns needed """
+        return Mea(mea_file=mea_file, cache=self.cache, downcast=self.downcast, columns=columns)
+
+    def _get_cached_result(self, command, input_files, parameters, outputs):
+        """ Copy the output files (by name) of an earlier run to their locations, returns False when there is none """
+
+        if self.result_cache is None:
+            return False
+
+        return self.result_cache.get(self.result_cache.get_key(command, input_files, parameters), outputs)
+
+    def _cache_result(self, command, input_files, parameters, outputs):
+        """ Store the output files (by name) of a run in the result cache """
+
+        if self.result_cache is None:
+            return False
+
+        return self.result_cache.put(self.result_cache.get_key(command, input_files, parameters), outputs,
+                                     command=command, input_files=input_files, parameters=parameters)
+
+    def summary(self, mea_file):
+        """ Report a summary of the measurements ...
+
+            The summary is read from the metadata next to the measurements file (<mea_file>.mzq.json),
+            which is (re)built from the measurements file when it is missing or out of date.
+        """
+
+        # load the metadata of the measurements file
+        mea = Mea(mea_file=mea_file, cache=self.cache, metadata=True)
+        metadata = mea.get_metadata()
+
+        # build summary dict
+        summary = {
+            'batches': mea.get_batches().tolist(),
+            'samples': mea.get_samples().tolist(),
+            'compounds': mea.get_compounds().tolist(),
+            'internal_standards': mea.get_internal_standards().tolist(),
+            'types': mea.get_types().tolist(),
+            'rows': metadata['rows'],
+            'rows_with_area': metadata['rows_with_area'],
+            'batch_times': {
+                batch: {key: details[key] for key in ['rows', 'start', 'end'] if key in details}
+                for batch, details in metadata['batch_details'].items()
             }
-        except:
-            summary = {}
+        }
 
         # return a json encoded dict
         return json.JSONEncoder().encode(summary)
@@ -55,7 +134,7 @@ class Qcli(object):
         """ Calculate the blank effect of ... """
 
         # load measurements file
-        mea = Mea(mea_file)
+        mea = self._load_mea(mea_file, columns=['compound', 'batch', 'type', 'area'])
 
         # init calc class
         qccalc = Qccalc(mea=mea)
@@ -66,71 +145,89 @@ class Qcli(object):
         # save results to file
         blank_effect.to_csv(blank_effect_file, sep="\t", index=False, encoding='utf-8')
 
-    def rt_shifts(self, mea_file, rt_shifts_file):
-        """ Calculate the RT shifts of each compound per batch ... """
+    def rt_shifts(self, mea_file, rt_shifts_file, column='rt'):
+        """ Calculate the RT shifts of each compound per batch, of the compound (rt) or its internal standard (rt_is) ... """
 
         # load measurements file
-        mea = Mea(mea_file)
+        mea = self._load_mea(mea_file, columns=['compound', 'batch', 'sample', column])
 
         # init calc class
         qccalc = Qccalc(mea=mea)
 
         # calculate qc rsd's
-        rt_shifts = qccalc.rt_shifts()
+        rt_shifts = qccalc.rt_shifts(column=column)
 
         # save results to file
         rt_shifts.to_csv(rt_shifts_file, sep="\t", index=False, encoding='utf-8')
 
-    def qc_correction(self, mea_file, qc_corrected_file):
+    def qc_correction(self, mea_file, qc_corrected_file, drift=False, span=0.75):
         """ Calculate the QC corrected data ... """
 
         # load measurements file
-        mea = Mea(mea_file)
+        mea = self._load_mea(mea_file)
 
         # init calc class
         qccalc = Qccalc(mea=mea)
 
         # calculate qc corrected data
-        qc_corrected = qccalc.qc_correction()
+        qc_corrected = qccalc.qc_correction(drift=drift, span=span)
 
         # save results to file
         qc_corrected.to_csv(qc_corrected_file, sep="\t", index=False, encoding='utf-8')
 
-    def qc_rsd(self, qc_corrected_file, qc_rsd_file, by_batch=False):
+    def qc_rsd(self, qc_corrected_file, qc_rsd_file, by_batch=False, bootstrap=0, confidence=0.95, seed=0, workers=1):
         """ Calculate the QC RSD's ... """
 
+        # the result of an earlier run on the same measurements
+        parameters = {'by_batch': by_batch, 'bootstrap': bootstrap, 'confidence': confidence, 'seed': seed}
+        if self._get_cached_result('qc_rsd', [qc_corrected_file], parameters, {'rsd.tsv': qc_rsd_file}):
+            return
+
         # load measurements file
-        mea = Mea(qc_corrected_file)
+        mea = self._load_mea(qc_corrected_file, columns=['compound', 'batch', 'type', 'area', 'ratio', 'inter_median_qc_corrected'])
 
         # init calc class
         qccalc = Qccalc(mea=mea)
 
         # calculate qc rsd's
-        rsdqc = qccalc.rsdqc(by_batch=by_batch)
+        rsdqc = qccalc.rsdqc(by_batch=by_batch, bootstrap=bootstrap, confidence=confidence, seed=seed, workers=workers)
 
         # save results to file
         rsdqc.to_csv(qc_rsd_file, sep="\t", index=False, encoding='utf-8')
+        self._cache_result('qc_rsd', [qc_corrected_file], parameters, {'rsd.tsv': qc_rsd_file})
 
-    def rep_rsd(self, qc_corrected_file, rep_rsd_file, by_batch=False):
+    def rep_rsd(self, qc_corrected_file, rep_rsd_file, by_batch=False, bootstrap=0, confidence=0.95, seed=0, workers=1):
         """ Calculate the Replicate RSD's ... """
 
+        # the result of an earlier run on the same measurements
+        parameters = {'by_batch': by_batch, 'bootstrap': bootstrap, 'confidence': confidence, 'seed': seed}
+        if self._get_cached_result('rep_rsd', [qc_corrected_file], parameters, {'rsd.tsv': rep_rsd_file}):
+            return
+
         # load measurements file
-        mea = Mea(qc_corrected_file)
+        mea = self._load_mea(qc_corrected_file, columns=[
+            'compound', 'batch', 'sample', 'injection', 'replicate', 'type', 'area', 'ratio', 'inter_median_qc_corrected'])
 
         # init calc class
         qccalc = Qccalc(mea=mea)
 
         # calculate qc rsd's
-        rsdrep = qccalc.rsdrep(by_batch=by_batch)
+        rsdrep = qccalc.rsdrep(by_batch=by_batch, bootstrap=bootstrap, confidence=confidence, seed=seed, workers=workers)
 
         # save results to file
         rsdrep.to_csv(rep_rsd_file, sep="\t", index=False, encoding='utf-8')
+        self._cache_result('rep_rsd', [qc_corrected_file], parameters, {'rsd.tsv': rep_rsd_file})
 
     def internal_standard_rsd(self, qc_corrected_file, is_rsd_file, by_batch=False):
         """ Calculate the Internal Standard RSD's ... """
 
+        # the result of an earlier run on the same measurements
+        parameters = {'by_batch': by_batch}
+        if self._get_cached_result('internal_standard_rsd', [qc_corrected_file], parameters, {'rsd.tsv': is_rsd_file}):
+            return
+
         # load measurements file
-        mea = Mea(qc_corrected_file)
+        mea = self._load_mea(qc_corrected_file, columns=['compound_is', 'aliquot', 'type', 'batch', 'area_is'])
 
         # init calc class
         qccalc = Qccalc(mea=mea)
@@ -140,12 +237,13 @@ class Qcli(object):
 
         # save results to file
         rsdis.to_csv(is_rsd_file, sep="\t", index=False, encoding='utf-8')
+        self._cache_result('internal_standard_rsd', [qc_corrected_file], parameters, {'rsd.tsv': is_rsd_file})
 
     def plot_compound(self, qc_corrected_file, compound, plot_location):
         """ plot an individual compound """
 
         # load measurements file
-        mea = Mea(mea_file=qc_corrected_file)
+        mea = self._load_mea(qc_corrected_file, columns=Qcplot.columns)
 
         # init plot class
         qcplot = Qcplot(mea=mea)
@@ -153,48 +251,352 @@ class Qcli(object):
         # plot the compound
         qcplot.plot_compound_qc_data(compound=compound, location=plot_location)
 
-    def plot_compounds(self, qc_corrected_file, plot_location):
-        """ plot a list of compounds """
+    def plot_compounds(self, qc_corrected_file, plot_location, workers=1, plotlyjs='embed'):
+        """ plot a list of compounds (using a number of worker processes)
+
+            plotlyjs is 'embed' (in each plot) or 'shared' (one plotly.min.js file next to the plots)
+        """
 
         # load measurements file
-        mea = Mea(mea_file=qc_corrected_file)
+        mea = self._load_mea(qc_corrected_file, columns=Qcplot.columns)
 
         # init plot class
         qcplot = Qcplot(mea=mea)
 
-        # plot the compound
-        for compound in mea.get_compounds():
-            qcplot.plot_compound_qc_data(compound=compound, location=plot_location)
+        # plot the compounds
+        qcplot.plot_compounds(compounds=mea.get_compounds(), location=plot_location, workers=workers, plotlyjs=plotlyjs)
 
-    def plot_compounds_zipped(self, qc_corrected_file, zip_file):
-        """ plot a list of compounds and store them as a zip file """
+    def plot_compounds_zipped(self, qc_corrected_file, zip_file, workers=1, plotlyjs='embed'):
+        """ plot a list of compounds (using a number of worker processes) and store them as a zip file """
 
         # load measurements file
-        mea = Mea(mea_file=qc_corrected_file)
+        mea = self._load_mea(qc_corrected_file, columns=Qcplot.columns)
 
         # init plot class
         qcplot = Qcplot(mea=mea)
 
-        # plot the compound
+        # plot the compounds
         with tempfile.TemporaryDirectory() as tmpdir:
-            for compound in mea.get_compounds():
-                qcplot.plot_compound_qc_data(compound=compound, location=tmpdir)
+            qcplot.plot_compounds(compounds=mea.get_compounds(), location=tmpdir, workers=workers, plotlyjs=plotlyjs)
 
             zipf = zipfile.ZipFile(zip_file, 'w', zipfile.ZIP_DEFLATED)
             for root, dirs, files in os.walk(tmpdir):
-                for file in files:
-                    if not os.path.isdir(file) and file.split('.')[-1].lower() == 'html':
+                for file in sorted(files):
+                    if not os.path.isdir(file) and file.split('.')[-1].lower() in ['html', 'js']:
                         zipf.write(os.path.join(root, file), file)
             zipf.close()
 
-    def export_measurements(self, file, column, export_location, include_is=False):
-        """ exports data as samples vs compounds"""
+    def plot_report(self, qc_corrected_file, report_file):
+        """ plot all compounds in a single page report, which draws the plot of the selected compound """
+
+        # load measurements file
+        mea = self._load_mea(qc_corrected_file, columns=Qcplot.columns)
+
+        # init plot class
+        qcplot = Qcplot(mea=mea)
+
+        # plot the compounds
+        qcplot.plot_compounds_report(compounds=mea.get_compounds(), report_file=report_file)
+
+    def export_measurements(self, file, column, export_location, include_is=False, matrix_location=''):
+        """ exports data as samples vs compounds
+
+            With matrix_location the values are also stored as float64 matrix in matrix_location.npy (to load
+            with np.load(mmap_mode='r')), with its rows and columns in matrix_location.rows.tsv and .columns.tsv
+        """
+
+        # the result of an earlier run on the same measurements
+        parameters = {'column': column, 'include_is': include_is}
+        outputs = {}
+        if export_location:
+            outputs['table.tsv'] = export_location
+        if matrix_location:
+            outputs.update({'matrix' + extension: matrix_location + extension for extension in ['.npy', '.rows.tsv', '.columns.tsv']})
+
+        if self._get_cached_result('export_measurements', [file], parameters, outputs):
+            return
 
         # load measurements file
-        mea = Mea(file)
+        mea = self._load_mea(file, columns=['sample', 'batch', 'compound', column] + (['area_is'] if include_is else []))
 
         # store as table
-        mea.as_table(column=column, location=export_location, include_is=include_is)
+        if export_location:
+            mea.as_table(column=column, location=export_location, include_is=include_is)
+
+        # store as matrix
+        if matrix_location:
+            mea.as_matrix(column=column, location=matrix_location, include_is=include_is)
+
+        self._cache_result('export_measurements', [file], parameters, outputs)
+
+    def run_all(self, mea_file, output_dir, plot=True, workers=1, plotlyjs='embed', report=False, output_format='tsv',
+                threads=4, writers=2, timings_file=''):
+        """ Run the complete QC workflow on a measurements file, loading it only once
+
+            The stages run in a pool of threads as soon as the stages they depend on are done, and their results
+            are written by background writer threads. The critical path (the chain of stages which sets the least
+            run time) is reported, and the start and end of all stages are saved in timings_file (JSON) when set.
+            With output_format=bundle the result tables and matrices are stored (typed, without formatting them
+            as text) as Feather files with a manifest.json in the directory bundle instead of tab separated
+            files, see bundle_export.
+        """
+
+        os.makedirs(output_dir, exist_ok=True)
+
+        def output(name):
+            return os.path.join(output_dir, name)
+
+        # results are saved as tab separated file or as table of the bundle
+        bundle = Bundle(bundle_dir=output('bundle')) if output_format == 'bundle' else None
+
+        def save(name, kind='result'):
+            if bundle is None:
+                return lambda table: table.to_csv(output(name + '.tsv'), sep="\t", index=False, encoding='utf-8')
+
+            return lambda table: bundle.add_table(name, table, kind=kind)
+
+        scheduler = Scheduler(workers=threads, writers=writers)
+
+        # load measurements file
+        scheduler.add_stage('load', lambda: self._load_mea(mea_file))
+
+        # calculations on the raw measurements
+        scheduler.add_stage('blank_effect', lambda mea: Qccalc(mea=mea).blank_effect(), ['load'], save('blank_effect'))
+        scheduler.add_stage('batch_blank_effect', lambda mea: Qccalc(mea=mea).blank_effect(by_batch=True), ['load'],
+                            save('batch_blank_effect'))
+        scheduler.add_stage('rt_shifts', lambda mea: Qccalc(mea=mea).rt_shifts(), ['load'], save('rt_shifts'))
+        scheduler.add_stage('export_area', lambda mea: mea.as_table(column='area', include_is=True), ['load'],
+                            save('area', kind='matrix'))
+        scheduler.add_stage('export_ratio', lambda mea: mea.as_table(column='ratio', include_is=False), ['load'],
+                            save('ratio', kind='matrix'))
+
+        # qc correction, the remaining stages use the corrected measurements (when there are QC's)
+        scheduler.add_stage('qc_correction', lambda mea: Qccalc(mea=mea).qc_correction(), ['load'],
+                            save('qc_corrected', kind='measurements'))
+
+        def load_qc_corrected(qc_corrected):
+            if not len(qc_corrected):
+                return None
+
+            qc_corrected_mea = Mea()
+            qc_corrected_mea.set_measurements(qc_corrected)
+
+            return qc_corrected_mea
+
+        scheduler.add_stage('load_qc_corrected', load_qc_corrected, ['qc_correction'])
+
+        for by_batch, prefix in [(False, ''), (True, 'batch_')]:
+            for calculation in ['rsdqc', 'rsdrep', 'rsdis']:
+                scheduler.add_stage(
+                    prefix + calculation,
+                    lambda mea, calculation=calculation, by_batch=by_batch: getattr(Qccalc(mea=mea), calculation)(by_batch=by_batch),
+                    ['load_qc_corrected'], save(prefix + calculation))
+
+        scheduler.add_stage('export_qc_inter', lambda mea: mea.as_table(column='inter_median_qc_corrected', include_is=False),
+                            ['load_qc_corrected'], save('qc_inter', kind='matrix'))
+
+        # the plot workers are started fresh (spawned), not forked from a process with running threads
+        if plot:
+            scheduler.add_stage('plot_compounds', lambda mea: Qcplot(mea=mea).plot_compounds(
+                compounds=mea.get_compounds(), location=output('plots'), workers=workers, plotlyjs=plotlyjs,
+                start_method='spawn' if threads > 1 else None), ['load_qc_corrected'])
+
+        if report:
+            scheduler.add_stage('plot_report', lambda mea: Qcplot(mea=mea).plot_compounds_report(
+                compounds=mea.get_compounds(), report_file=output('report.html')), ['load_qc_corrected'])
+
+        try:
+            scheduler.run()
+
+            # the bundle is complete when all results are written
+            timings = scheduler.get_timings()
+            if bundle is not None:
+                start = time.time()
+                bundle.close()
+                timings['save_bundle'] = round(time.time() - start, 3)
+        finally:
+            # no partial bundle is left behind when a stage failed
+            if bundle is not None:
+                bundle.abort()
+
+        # critical path
+        scheduler_report = scheduler.get_report()
+        print(" - wall time {:.2f}s, stages and writes {:.2f}s, critical path {:.2f}s:".format(
+            scheduler_report['wall'], scheduler_report['serial'], scheduler_report['critical_path']['seconds']),
+            file=sys.stderr)
+        for stage in scheduler_report['critical_path']['stages']:
+            print("   {:<24} {:.2f}s".format(stage['stage'], stage['seconds']), file=sys.stderr)
+
+        if timings_file:
+            with open(timings_file, 'w') as timings_output:
+                json.dump(scheduler_report, timings_output, indent=2)
+
+        # return a json encoded dict with the timings
+        return json.JSONEncoder().encode(timings)
+
+    def result_cache_inspect(self, results=True):
+        """ Show the status of the result cache (--result-cache), and its results from least to most recently used """
+
+        if self.result_cache is None:
+            raise ValueError("No result cache is set, use --result-cache=<directory>")
+
+        status = self.result_cache.get_status()
+        if results:
+            status['entries'] = [
+                {key: entry[key] for key in ['key', 'command', 'inputs', 'parameters', 'size', 'hits', 'last_used']}
+                for entry in self.result_cache.get_entries()
+            ]
+
+        return json.JSONEncoder().encode(status)
+
+    def result_cache_purge(self, command=''):
+        """ Remove all results from the result cache (--result-cache), or only those of a command (e.g. qc_rsd) """
+
+        if self.result_cache is None:
+            raise ValueError("No result cache is set, use --result-cache=<directory>")
+
+        return self.result_cache.purge(command=command)
+
+    def bundle_export(self, bundle_dir, output_dir, tables=''):
+        """ Export the tables of a results bundle (all, or the comma separated tables) as tab separated files """
+
+        tables = tables.split(',') if isinstance(tables, str) and tables else list(tables)
+
+        return Bundle(bundle_dir=bundle_dir).export_tsv(output_dir, tables=tables)
+
+    def run_manifest(self, manifest_file, summary_file='', workers=0, memory_budget=4096, memory_factor=8,
+                     plot=True, plotlyjs='embed', report=False):
+        """ Run the complete QC workflow on each study of a manifest, in a pool of worker processes ...
+
+            The manifest is a tab separated file with the columns mea_file and output_dir, one study per row.
+            A failing study does not stop the others, the status and timings of each study are returned
+            (and saved in summary_file). Studies are only started while their estimated memory use
+            (memory_factor times the file size) fits in memory_budget (MB), one study always runs.
+        """
+
+        manifest = pd.read_csv(manifest_file, sep="\t", dtype=str, keep_default_na=False)
+        workers = workers if workers > 0 else (os.cpu_count() or 1)
+        memory_budget = memory_budget * 1024 ** 2
+
+        # the studies in order of the manifest, with their estimated memory use
+        pending = collections.deque()
+        for study in manifest[['mea_file', 'output_dir']].to_dict(orient='records'):
+            size = os.path.getsize(study['mea_file']) if os.path.isfile(study['mea_file']) else 0
+            study['estimated_memory'] = memory_factor * size
+            pending.append(study)
+
+        options = {'cache': self.cache, 'downcast': self.downcast}
+        results = []
+        running = {}
+
+        executor = ProcessPoolExecutor(max_workers=workers)
+        try:
+            while pending or running:
+
+                # start studies while they fit in the memory budget, a retried study runs on its own
+                used = sum(study['estimated_memory'] for study in running.values())
+                while pending and len(running) < workers and (
+                        not running or used + pending[0]['estimated_memory'] <= memory_budget) and (
+                        not running or not pending[0].get('retry')) and (
+                        not any(study.get('retry') for study in running.values())):
+                    study = pending.popleft()
+                    used += study['estimated_memory']
+                    running[executor.submit(
+                        run_manifest_study, options, study['mea_file'], study['output_dir'], plot, plotlyjs, report
+                    )] = study
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                broken = []
+                for future in done:
+                    study = running.pop(future)
+                    try:
+                        results.append(dict(study, **future.result()))
+                    except BrokenProcessPool:
+                        broken.append(study)
+
+                # a worker which died (e.g. out of memory) breaks the pool and the studies running in it, these are
+                # retried once on their own in a new pool, a study which fails again on its own is the cause
+                if broken:
+                    broken.extend(running.values())
+                    running = {}
+                    executor.shutdown(wait=True)
+                    executor = ProcessPoolExecutor(max_workers=workers)
+
+                    for study in reversed(broken):
+                        if study.get('retry'):
+                            results.append(dict(study, status='failed', error='the worker process died'))
+                        else:
+                            pending.appendleft(dict(study, retry=True))
+        finally:
+            executor.shutdown(wait=True)
+
+        # summary in the order of the manifest
+        order = {study['mea_file'] + '\t' + study['output_dir']: i for i, study in enumerate(manifest.to_dict(orient='records'))}
+        results.sort(key=lambda result: order.get(result['mea_file'] + '\t' + result['output_dir'], len(order)))
+
+        for result in results:
+            result.pop('retry', None)
+
+        summary = pd.DataFrame(results, columns=['mea_file', 'output_dir', 'status', 'seconds', 'estimated_memory', 'error', 'timings'])
+        if summary_file:
+            summary.assign(timings=summary['timings'].map(lambda timings: json.dumps(timings) if isinstance(timings, dict) else '')).to_csv(
+                summary_file, sep="\t", index=False, encoding='utf-8')
+
+        # return a json encoded dict
+        return json.JSONEncoder().encode({
+            'studies': len(results),
+            'failed': sum(result['status'] != 'ok' for result in results),
+            'results': results
+        })
+
+    def append_batch(self, mea_file, state_dir, qc_rsd_file='', is_rsd_file=''):
+        """ Add the batch(es) in a measurements file to the QC state of a study """
+
+        # load measurements file (with only the new batch)
+        mea = self._load_mea(mea_file, columns=Qcstate.columns)
+
+        # load the state, and update it with the new batch
+        qcstate = Qcstate(state_dir=state_dir)
+        changed_factors = qcstate.append_batch(mea)
+
+        # save the updated RSD's of the whole study
+        if qc_rsd_file:
+            qcstate.rsdqc().to_csv(qc_rsd_file, sep="\t", index=False, encoding='utf-8')
+
+        if is_rsd_file:
+            qcstate.rsdis().to_csv(is_rsd_file, sep="\t", index=False, encoding='utf-8')
+
+        # return a json encoded dict
+        return json.JSONEncoder().encode({
+            'batches': qcstate.get_batches().tolist(),
+            'changed_factors': len(changed_factors)
+        })
+
+    def generate(self, mea_file, batches=3, samples=80, compounds=3, internal_standards=2, qc_ratio=0.2,
+                 blank_ratio=0.05, cal_ratio=0.15, replicate_ratio=0.1, missing_rate=0.01, seed=0):
+        """ Write a synthetic (seeded) measurements file, e.g. to benchmark larger studies ... """
+
+        generator = Generator(batches=batches, samples=samples, compounds=compounds,
+                              internal_standards=internal_standards, qc_ratio=qc_ratio, blank_ratio=blank_ratio,
+                              cal_ratio=cal_ratio, replicate_ratio=replicate_ratio, missing_rate=missing_rate,
+                              seed=seed)
+        rows = generator.write_mea_file(mea_file)
+
+        # return a json encoded dict
+        return json.JSONEncoder().encode({'mea_file': mea_file, 'rows': rows})
+
+    def serve(self, host='127.0.0.1', port=8080, memory_limit=1024):
+        """ Serve the methods as a local HTTP/JSON service, loaded studies are kept in memory (memory_limit in MB) ...
+
+            GET /status and /clear show and empty the cache of studies. Other methods are
+            POST /<method> with a JSON object, or GET /<method>?mea_file=...&by_batch=true, e.g.
+            {"mea_file": "data/combined.tsv", "by_batch": true} to /qc_rsd. Methods are summary,
+            blank_effect, rt_shifts, qc_correction, qc_rsd, rep_rsd, internal_standard_rsd, export
+            and plot_compound. Results are returned as JSON, or saved when output_file is given.
+        """
+
+        qcserver = Qcserver(host=host, port=port, memory_limit=memory_limit, cache=self.cache, downcast=self.downcast)
+        qcserver.serve()
 
     def test_cli(self):
         """ Test all methods of the API with one command"""
@@ -202,6 +604,7 @@ class Qcli(object):
         # input vars
         command_prefix = 'python qcli.py'
         mea_file = './data/combined.tsv'
+        bad_datetime_file = './data/bad_datetime.tsv'
         blank_effect_file = './data/blank_effect.tsv'
         batch_blank_effect_file = './data/batch_blank_effect.tsv'
         rt_shifts_file = './data/rt_shifts.tsv'
@@ -214,6 +617,23 @@ class Qcli(object):
         batch_is_rsd_file = './data/batch_rsdis.tsv'
         plot_location = './data/plots/'
         zip_file = './data/plots.zip'
+        report_file = './data/report.html'
+        run_all_location = './data/run_all/'
+        bundle_location = './data/run_all_bundle/'
+        result_cache_location = './data/result_cache/'
+        cached_qc_rsd_file = './data/cached_rsdqc.tsv'
+        bundle_export_location = './data/run_all_bundle/tsv/'
+        generated_file = './data/generated.tsv'
+        manifest_file = './data/manifest.tsv'
+        manifest_summary_file = './data/manifest_summary.tsv'
+        manifest_location = './data/run_manifest/'
+        state_dir = './data/qc_state/'
+        shard_dir = './data/shards/'
+        qc_corrected_shard_dir = './data/shards/qc_corrected/'
+        state_batches_file = './data/state_batches.tsv'
+        state_last_batch_file = './data/state_last_batch.tsv'
+        state_qc_rsd_file = './data/state_rsdqc.tsv'
+        state_is_rsd_file = './data/state_rsdis.tsv'
 
         export_area_file = mea_file
         export_area_column = 'area'
@@ -229,6 +649,27 @@ class Qcli(object):
         export_qc_inter_column = 'inter_median_qc_corrected'
         export_qc_inter_location = './data/qc_inter.tsv'
         export_qc_inter_is = False
+        export_qc_inter_matrix = './data/qc_inter'
+
+        # compare two result tables by their keys, values may differ in the last (rounded) decimal
+        def assert_same_results(result, expected, keys):
+            if isinstance(result, str):
+                result = pd.read_csv(result, sep="\t")
+            if isinstance(expected, str):
+                expected = pd.read_csv(expected, sep="\t")
+
+            if len(result) != len(expected):
+                raise RuntimeError("Expected {} rows, got {}".format(len(expected), len(result)))
+
+            merged = expected.merge(result, on=keys, how='left', suffixes=('', '_result'))
+            for column in expected.columns.drop(keys):
+                if pd.api.types.is_numeric_dtype(expected[column]):
+                    same = np.isclose(merged[column].astype(float), merged[column + '_result'].astype(float),
+                                      atol=0.011, equal_nan=True)
+                else:
+                    same = (merged[column] == merged[column + '_result']).values
+                if not same.all():
+                    raise RuntimeError("Column {} differs from the expected results".format(column))
 
         try:
 
@@ -248,6 +689,18 @@ class Qcli(object):
             print("Found {} batches, {} samples, and {} compounds.".format(
                 len(batches), len(samples), len(compounds)))
 
+            # summary of measurements with a datetime which can not be parsed, stdout is still only the summary
+            bad_datetime = pd.read_csv(mea_file, sep="\t", dtype=str, keep_default_na=False)
+            bad_datetime.loc[0, 'datetime'] = 'not a date'
+            bad_datetime.to_csv(bad_datetime_file, sep="\t", index=False, encoding='utf-8')
+            if os.path.isfile(bad_datetime_file + '.mzq.json'):
+                os.remove(bad_datetime_file + '.mzq.json')
+            summary_proc = Popen("{} summary --mea-file={}".format(command_prefix, bad_datetime_file), stdout=PIPE, shell=True)
+            out, err = summary_proc.communicate(timeout=15)
+            if json.loads(out.decode('utf8'))['rows'] != summary['rows']:
+                raise RuntimeError("The summary of {} is incomplete".format(bad_datetime_file))
+            print(" - summary with an unparseable datetime passed...")
+
             # blank effect
             run("{} blank-effect --mea-file={} --blank-effect-file={}".format(
                 command_prefix,
@@ -288,6 +741,31 @@ class Qcli(object):
             ), shell=True, check=True)
             print(" - qc-rsd by batch passed...")
 
+            # the same qc rsd twice, the second time from the result cache
+            for _ in range(2):
+                run("{} qc-rsd --qc-corrected-file={} --qc-rsd-file={} --result-cache={}".format(
+                    command_prefix,
+                    qc_corrected_file, cached_qc_rsd_file, result_cache_location
+                ), shell=True, check=True)
+            if not pd.read_csv(cached_qc_rsd_file, sep="\t").equals(pd.read_csv(qc_rsd_file, sep="\t")):
+                raise RuntimeError("The cached qc rsd's differ from {}".format(qc_rsd_file))
+
+            # a cached result with a missing output file is calculated again
+            for cached_output in glob.glob(os.path.join(result_cache_location, 'results', '*', 'rsd.tsv')):
+                os.remove(cached_output)
+            os.remove(cached_qc_rsd_file)
+            run("{} qc-rsd --qc-corrected-file={} --qc-rsd-file={} --result-cache={}".format(
+                command_prefix,
+                qc_corrected_file, cached_qc_rsd_file, result_cache_location
+            ), shell=True, check=True)
+            if not pd.read_csv(cached_qc_rsd_file, sep="\t").equals(pd.read_csv(qc_rsd_file, sep="\t")):
+                raise RuntimeError("The recalculated qc rsd's differ from {}".format(qc_rsd_file))
+            run("{} result-cache-purge --result-cache={}".format(
+                command_prefix,
+                result_cache_location
+            ), shell=True, check=True, stdout=PIPE)
+            print(" - qc-rsd (result cache) passed...")
+
             # rep rsd
             run("{} rep-rsd --qc-corrected-file={} --rep-rsd-file={}".format(
                 command_prefix,
@@ -314,6 +792,33 @@ class Qcli(object):
             ), shell=True, check=True)
             print(" - is-rsd by batch passed...")
 
+            # QC state, updated with the last batch, gives the RSD's of the whole study
+            measurements = pd.read_csv(mea_file, sep="\t", dtype=str, keep_default_na=False)
+            last_batch = pd.to_numeric(measurements['batch']) == batches[-1]
+            measurements[~last_batch].to_csv(state_batches_file, sep="\t", index=False, encoding='utf-8')
+            measurements[last_batch].to_csv(state_last_batch_file, sep="\t", index=False, encoding='utf-8')
+            if os.path.isdir(state_dir):
+                shutil.rmtree(state_dir)
+            for batch_file in [state_batches_file, state_last_batch_file]:
+                run("{} append-batch --mea-file={} --state-dir={} --qc-rsd-file={} --is-rsd-file={}".format(
+                    command_prefix,
+                    batch_file, state_dir, state_qc_rsd_file, state_is_rsd_file
+                ), shell=True, check=True, stdout=PIPE)
+            assert_same_results(state_qc_rsd_file, qc_rsd_file, ['compound'])
+            assert_same_results(state_is_rsd_file, is_rsd_file, ['internal_standard'])
+            print(" - append-batch passed...")
+
+            # measurements partitioned by batch, QC corrected and calculated one batch at a time
+            if os.path.isdir(shard_dir):
+                shutil.rmtree(shard_dir)
+            sharded_mea = Mea(mea_file=mea_file, shard_dir=shard_dir)
+            if sorted(sharded_mea.get_batch_files()) != batches:
+                raise RuntimeError("The partitioned batches differ from the batches of {}".format(mea_file))
+            sharded_qc_corrected = Qccalc(mea=sharded_mea).qc_correction_by_batch_files(qc_corrected_shard_dir)
+            assert_same_results(Qccalc(mea=sharded_qc_corrected).by_batch_files('rsdqc', by_batch=True),
+                                batch_qc_rsd_file, ['compound', 'batch'])
+            print(" - qc-rsd by batch (partitioned) passed...")
+
             # export_measurements (area)
             run("{} export-measurements --file={} --column={} --export_location={} --include_is={}".format(
                 command_prefix,
@@ -329,9 +834,10 @@ class Qcli(object):
             print(" - export ratio's passed...")
 
             # export_measurements (qc_corrected)
-            run("{} export-measurements --file={} --column={} --export_location={} --include_is={}".format(
+            run("{} export-measurements --file={} --column={} --export_location={} --include_is={} --matrix_location={}".format(
                 command_prefix,
-                export_qc_inter_file, export_qc_inter_column, export_qc_inter_location, export_qc_inter_is
+                export_qc_inter_file, export_qc_inter_column, export_qc_inter_location, export_qc_inter_is,
+                export_qc_inter_matrix
             ), shell=True, check=True)
             print(" - export qc_inter passed...")
 
@@ -359,9 +865,116 @@ class Qcli(object):
             ), shell=True, check=True)
             print("  - plot compounds (zipped) passed...")
 
+            print(" + plot report")
+            run("{} plot-report --qc-corrected-file={} --report-file={}".format(
+                command_prefix,
+                qc_corrected_file, report_file
+            ), shell=True, check=True)
+            print("  - plot report passed...")
+
+            # complete workflow in a single process
+            print(" + run all")
+            run("{} run-all --mea-file={} --output-dir={}".format(
+                command_prefix,
+                mea_file, run_all_location
+            ), shell=True, check=True)
+            print("  - run all passed...")
+
+            print(" + run all (bundle)")
+            run_all_proc = run("{} run-all --mea-file={} --output-dir={} --plot=False --output-format=bundle".format(
+                command_prefix,
+                mea_file, bundle_location
+            ), shell=True, check=True, stdout=PIPE)
+            json.loads(run_all_proc.stdout.decode('utf8'))  # the progress of the stages is not mixed into the result
+            run("{} bundle-export --bundle-dir={} --output-dir={}".format(
+                command_prefix,
+                os.path.join(bundle_location, 'bundle'), bundle_export_location
+            ), shell=True, check=True, stdout=PIPE)
+            print("  - run all (bundle) passed...")
+
+            # synthetic measurements, and a summary of them
+            print(" + generate")
+            run("{} generate --mea-file={} --batches=2 --samples=20 --compounds=5".format(
+                command_prefix,
+                generated_file
+            ), shell=True, check=True)
+            run("{} summary --mea-file={}".format(
+                command_prefix,
+                generated_file
+            ), shell=True, check=True, stdout=PIPE)
+            print("  - generate passed...")
+
+            # both studies in a pool of worker processes
+            print(" + run manifest")
+            pd.DataFrame({
+                'mea_file': [mea_file, generated_file],
+                'output_dir': [os.path.join(manifest_location, 'combined'), os.path.join(manifest_location, 'generated')]
+            }).to_csv(manifest_file, sep="\t", index=False, encoding='utf-8')
+            run("{} run-manifest --manifest-file={} --summary-file={} --workers=2 --plot=False".format(
+                command_prefix,
+                manifest_file, manifest_summary_file
+            ), shell=True, check=True, stdout=PIPE)
+            if (pd.read_csv(manifest_summary_file, sep="\t")['status'] != 'ok').any():
+                raise RuntimeError("A study of the manifest failed, see {}".format(manifest_summary_file))
+            print("  - run manifest passed...")
+
+            # local HTTP/JSON service, on a free port
+            print(" + serve")
+            with socket.socket() as free_socket:
+                free_socket.bind(('127.0.0.1', 0))
+                port = free_socket.getsockname()[1]
+            serve_proc = Popen("exec {} serve --port={}".format(command_prefix, port), stdout=DEVNULL, shell=True)
+            try:
+                url = 'http://127.0.0.1:{}/'.format(port)
+                for attempt in range(50):
+                    try:
+                        with urllib.request.urlopen(url + 'summary?mea_file=' + mea_file, timeout=15) as response:
+                            served_summary = json.loads(response.read().decode('utf8'))
+                        break
+                    except urllib.error.HTTPError:
+                        raise
+                    except (urllib.error.URLError, ConnectionError):
+                        time.sleep(0.2)
+                else:
+                    raise RuntimeError("The service did not start on port {}".format(port))
+                if served_summary['compounds'] != compounds:
+                    raise RuntimeError("The service returned another summary than the summary command")
+                try:
+                    urllib.request.urlopen(url + 'unknown?mea_file=' + mea_file, timeout=15)
+                    raise RuntimeError("The service accepted an unknown operation")
+                except urllib.error.HTTPError as error:
+                    if error.code != 404:
+                        raise
+            finally:
+                serve_proc.terminate()
+                serve_proc.wait(timeout=15)
+            print("  - serve passed...")
+
         except:
             print("Unexpected error:", sys.exc_info()[0])
             raise
 
+def run_manifest_study(options, mea_file, output_dir, plot, plotlyjs, report):
+    """ Run the complete QC workflow on one study of a manifest (in a worker process), the output is logged in its output directory """
+
+    result = {'mea_file': mea_file, 'output_dir': output_dir, 'status': 'ok', 'error': '', 'timings': {}}
+    start = time.time()
+
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+        with open(os.path.join(output_dir, 'run_all.log'), 'w') as log, contextlib.redirect_stdout(log), \
+                contextlib.redirect_stderr(log):
+            timings = Qcli(**options).run_all(mea_file=mea_file, output_dir=output_dir, plot=plot,
+                                              plotlyjs=plotlyjs, report=report)
+        result['timings'] = json.loads(timings)
+    except Exception as error:
+        result['status'] = 'failed'
+        result['error'] = '{}: {}'.format(type(error).__name__, error)
+        result['traceback'] = traceback.format_exc()
+
+    result['seconds'] = round(time.time() - start, 3)
+
+    return result
+
 if __name__ == '__main__':
     fire.Fire(Qcli)
\ No newline at end of file
@@ -0,0 +1,118 @@
+import os
+import sys
+import fire
+import json
+import time
+import platform
+import tempfile
+import datetime
+import tracemalloc
+import numpy as np
+import pandas as pd
+from lib.mea import Mea
+from lib.qccalc import Qccalc
+from lib.qcplot import Qcplot
+from lib.generator import Generator
+
+# size ladder, relative to the example data (3 batches, 80 samples per batch and 3 compounds)
+sizes = {
+    '1x': {'batches': 3, 'samples': 80, 'compounds': 3, 'internal_standards': 2},
+    '10x': {'batches': 6, 'samples': 80, 'compounds': 15, 'internal_standards': 5},
+    '100x': {'batches': 10, 'samples': 160, 'compounds': 54, 'internal_standards': 12},
+}
+
+
+# time a call, and measure its peak memory use in a second (traced) call
+def measure(function, memory=True):
+
+    start = time.perf_counter()
+    function()
+    seconds = time.perf_counter() - start
+
+    peak_memory = None
+    if memory:
+        tracemalloc.start()
+        function()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return seconds, peak_memory
+
+
+# the methods to benchmark on a measurements file, by name (a new Qccalc each call, nothing is reused)
+def benchmarks(mea_file, location):
+
+    mea = Mea(mea_file=mea_file)
+
+    qc_corrected = Mea()
+    qc_corrected.set_measurements(Qccalc(mea=mea).qc_correction())
+
+    qcplot = Qcplot(mea=qc_corrected)
+    compound = mea.get_compounds()[0]
+
+    return {
+        'read_mea_file': lambda: Mea().read_mea_file(mea_file=mea_file),
+        'as_table': lambda: mea.as_table(column='area', include_is=True),
+        'blank_effect': lambda: Qccalc(mea=mea).blank_effect(),
+        'batch_blank_effect': lambda: Qccalc(mea=mea).blank_effect(by_batch=True),
+        'rt_shifts': lambda: Qccalc(mea=mea).rt_shifts(),
+        'qc_correction': lambda: Qccalc(mea=mea).qc_correction(),
+        'rsdqc': lambda: Qccalc(mea=qc_corrected).rsdqc(),
+        'batch_rsdqc': lambda: Qccalc(mea=qc_corrected).rsdqc(by_batch=True),
+        'rsdrep': lambda: Qccalc(mea=qc_corrected).rsdrep(),
+        'batch_rsdrep': lambda: Qccalc(mea=qc_corrected).rsdrep(by_batch=True),
+        'rsdis': lambda: Qccalc(mea=qc_corrected).rsdis(),
+        'batch_rsdis': lambda: Qccalc(mea=qc_corrected).rsdis(by_batch=True),
+        'plot_compound_qc_data': lambda: qcplot.plot_compound_qc_data(compound=compound, location=location),
+    }
+
+
+# run the benchmark suite on generated data of each size and store the results as JSON
+def run(output='benchmark.json', ladder='1x,10x,100x', seed=0, memory=True, only=''):
+
+    ladder = ladder.split(',') if isinstance(ladder, str) else list(ladder)
+    only = only.split(',') if isinstance(only, str) and only else list(only)
+
+    results = {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'seed': seed,
+        'sizes': {size: sizes[size] for size in ladder},
+        'results': []
+    }
+
+    print("{:>6} {:>10} {:<24} {:>10} {:>12}".format('size', 'rows', 'method', 'seconds', 'peak MB'))
+
+    with tempfile.TemporaryDirectory() as location:
+        for size in ladder:
+            mea_file = os.path.join(location, 'measurements_{}.tsv'.format(size))
+            rows = Generator(seed=seed, **sizes[size]).write_mea_file(mea_file)
+
+            for method, function in benchmarks(mea_file, location).items():
+                if only and method not in only:
+                    continue
+
+                seconds, peak_memory = measure(function, memory=memory)
+                results['results'].append({
+                    'size': size,
+                    'rows': rows,
+                    'method': method,
+                    'seconds': round(seconds, 6),
+                    'peak_memory': peak_memory
+                })
+
+                print("{:>6} {:>10} {:<24} {:>10.4f} {:>12}".format(
+                    size, rows, method, seconds, '-' if peak_memory is None else round(peak_memory / 1e6, 2)))
+                sys.stdout.flush()
+
+    with open(output, 'w') as benchmark_file:
+        json.dump(results, benchmark_file, indent=2)
+
+    return output
+
+
+if __name__ == '__main__':
+    fire.Fire(run)
@@ -0,0 +1,155 @@
+import os
+import json
+import shutil
+import threading
+
+# the bundle is optional, it requires pyarrow
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:
+    pa = None
+
+# directory with typed result tables, each table is an (uncompressed) Feather file so it can be memory mapped on its
+# own and read by any Arrow reader, the manifest (manifest.json) describes the tables
+class Bundle:
+
+    # the file with the manifest, in the bundle directory
+    manifest_file = 'manifest.json'
+
+    # the extension of the tables
+    table_extension = '.feather'
+
+    def __init__(self, bundle_dir=''):
+
+        # init
+        self.bundle_dir = bundle_dir
+        self.manifest = None
+        self.writing = False
+        self.lock = threading.Lock()
+
+    # get the bundle directory
+    def get_bundle_dir(self):
+        return self.bundle_dir
+
+    # get the directory the bundle is written to, it replaces the bundle directory when it is closed
+    def get_tmp_dir(self):
+        return self.get_bundle_dir().rstrip(os.sep) + '.tmp'
+
+    # get the manifest, with the name, kind, file, rows and columns (with type) of each table
+    def get_manifest(self):
+
+        if self.manifest is None:
+            self.manifest = self.read_manifest()
+
+        return self.manifest
+
+    # get the names of the tables, optionally of one kind ('result', 'matrix' or 'measurements')
+    def get_tables(self, kind=''):
+        return [table['name'] for table in self.get_manifest()['tables'] if not kind or table['kind'] == kind]
+
+    # start writing the bundle (to a temporary directory, which replaces the bundle directory when it is closed)
+    def open(self):
+
+        if pa is None:
+            raise ImportError("Writing a bundle requires pyarrow")
+
+        if os.path.isdir(self.get_tmp_dir()):
+            shutil.rmtree(self.get_tmp_dir())
+        os.makedirs(self.get_tmp_dir())
+
+        self.manifest = {'version': 2, 'tables': []}
+        self.writing = True
+
+        return self
+
+    # add a table to the bundle (tables can be added by several threads)
+    def add_table(self, name, table, kind='result'):
+
+        with self.lock:
+            if not self.writing:
+                self.open()
+
+            if name in self.get_tables():
+                raise ValueError("Table '{}' is already in the bundle".format(name))
+
+            entry = {'name': name, 'kind': kind, 'file': name + self.table_extension, 'rows': len(table)}
+            self.manifest['tables'].append(entry)
+
+        arrow_table = pa.Table.from_pandas(table, preserve_index=False)
+        feather.write_feather(arrow_table, os.path.join(self.get_tmp_dir(), entry['file']), compression='uncompressed')
+
+        entry['columns'] = [{'name': field.name, 'type': str(field.type)} for field in arrow_table.schema]
+
+        return True
+
+    # write the manifest and replace the bundle directory
+    def close(self):
+
+        if not self.writing:
+            return False
+
+        try:
+            with open(os.path.join(self.get_tmp_dir(), self.manifest_file), 'w') as f:
+                json.dump(self.manifest, f, indent=2)
+
+            if os.path.isdir(self.get_bundle_dir()):
+                shutil.rmtree(self.get_bundle_dir())
+            os.replace(self.get_tmp_dir(), self.get_bundle_dir())
+            self.writing = False
+        except BaseException:
+            self.abort()
+            raise
+
+        return True
+
+    # stop writing the bundle, the temporary directory is removed and an existing bundle is kept
+    def abort(self):
+
+        self.writing = False
+
+        if os.path.isdir(self.get_tmp_dir()):
+            shutil.rmtree(self.get_tmp_dir())
+
+        return True
+
+    # read a table, as pandas dataframe or (without copying the memory mapped data) as Arrow table
+    def read_table(self, name, arrow=False):
+
+        if pa is None:
+            raise ImportError("Reading a bundle requires pyarrow")
+
+        tables = {table['name']: table for table in self.get_manifest()['tables']}
+        if name not in tables:
+            raise KeyError("Table '{}' is not in the bundle".format(name))
+
+        arrow_table = feather.read_table(os.path.join(self.get_bundle_dir(), tables[name]['file']), memory_map=True)
+
+        return arrow_table if arrow else arrow_table.to_pandas()
+
+    # export the tables as tab separated files (named after the tables) in output_dir
+    def export_tsv(self, output_dir, tables=None):
+
+        os.makedirs(output_dir, exist_ok=True)
+
+        files = []
+        for name in tables or self.get_tables():
+            files.append(os.path.join(output_dir, name + '.tsv'))
+            self.read_table(name).to_csv(files[-1], sep="\t", index=False, encoding='utf-8')
+
+        return files
+
+    # *************************************
+    # HELPER FUNCTIONS
+    # *************************************
+
+    # read the manifest of the bundle
+    def read_manifest(self):
+
+        manifest_file = os.path.join(self.get_bundle_dir(), self.manifest_file)
+
+        if not os.path.isfile(manifest_file):
+            raise ValueError("{} is not a results bundle".format(self.get_bundle_dir()))
+
+        with open(manifest_file) as f:
+            return json.load(f)
@@ -0,0 +1,158 @@
+import datetime
+import numpy as np
+import pandas as pd
+
+# generator of (seeded) synthetic measurements in the format of a measurements file
+class Generator:
+
+    # columns of a measurements file, in order
+    columns = ['sample', 'aliquot', 'type', 'injection', 'replicate', 'batch', 'order', 'datetime',
+               'compound', 'rt', 'area', 'compound_is', 'rt_is', 'area_is']
+
+    def __init__(self, batches=3, samples=80, compounds=3, internal_standards=2, qc_ratio=0.2, blank_ratio=0.05,
+                 cal_ratio=0.15, replicate_ratio=0.1, missing_rate=0.01, seed=0):
+
+        # init
+        self.batches = batches
+        self.samples = samples  # study samples per batch
+        self.compounds = compounds
+        self.internal_standards = min(internal_standards, compounds)
+        self.qc_ratio = qc_ratio  # injections of QC's, blanks and calibrants relative to the study samples
+        self.blank_ratio = blank_ratio
+        self.cal_ratio = cal_ratio
+        self.replicate_ratio = replicate_ratio  # study samples which are injected a second time
+        self.missing_rate = missing_rate  # measurements (and internal standards) without a value
+        self.seed = seed
+
+    # get the compound names
+    def get_compounds(self):
+        return np.array(['C{:04d}'.format(compound + 1) for compound in range(self.compounds)], dtype=object)
+
+    # get the internal standard names
+    def get_internal_standards(self):
+        return np.array(['IS{:03d}'.format(standard + 1) for standard in range(self.internal_standards)], dtype=object)
+
+    # generate the measurements, one row per injection and compound
+    def generate(self):
+
+        rng = np.random.RandomState(self.seed)
+
+        injections = self.generate_injections(rng)
+        compounds = self.get_compounds()
+        internal_standards = self.get_internal_standards()
+
+        n_injections = len(injections)
+        n_compounds = len(compounds)
+
+        # each compound is corrected with one of the internal standards
+        compound_is = np.arange(n_compounds) % len(internal_standards)
+
+        # the same compound has a similar rt and concentration everywhere, internal standards are spiked
+        compound_rt = rng.uniform(1, 10, n_compounds)
+        compound_level = rng.lognormal(8, 1.5, n_compounds)
+        is_rt = compound_rt[:len(internal_standards)] + rng.normal(0, 0.05, len(internal_standards))
+        is_level = rng.lognormal(11, 0.5, len(internal_standards))
+
+        # the instrument response differs per batch and drifts within a batch, for compounds and internal standards
+        batch_index = injections['batch'].values - 1
+        batch_response = rng.lognormal(0, 0.2, (self.batches, len(internal_standards)))
+        drift = 1 - 0.2 * injections['order'].values / injections['order'].max()
+        injection_response = rng.lognormal(0, 0.05, n_injections) * drift
+        is_response = batch_response[batch_index] * injection_response[:, np.newaxis]
+
+        # the internal standard is measured once per injection
+        is_area = is_level * is_response * rng.lognormal(0, 0.05, is_response.shape)
+        is_rt_measured = is_rt + rng.normal(0, 0.01, is_response.shape)
+
+        # concentrations relative to the compound level, QC's are a pool of the samples
+        concentration = injections['concentration'].values[:, np.newaxis] * rng.lognormal(0, 0.05, (n_injections, n_compounds))
+        area = compound_level * concentration * is_response[:, compound_is] * rng.lognormal(0, 0.05, (n_injections, n_compounds))
+        rt = compound_rt + rng.normal(0, 0.02, (self.batches, n_compounds))[batch_index] + rng.normal(0, 0.01, (n_injections, n_compounds))
+
+        measurements = pd.DataFrame({
+            column: np.repeat(injections[column].values, n_compounds)
+            for column in ['sample', 'aliquot', 'type', 'injection', 'replicate', 'batch', 'order', 'datetime']
+        })
+        measurements['compound'] = np.tile(compounds, n_injections)
+        measurements['rt'] = rt.ravel()
+        measurements['area'] = np.round(area.ravel())
+        measurements['compound_is'] = np.tile(internal_standards[compound_is], n_injections)
+        measurements['rt_is'] = is_rt_measured[:, compound_is].ravel()
+        measurements['area_is'] = np.round(is_area[:, compound_is].ravel())
+
+        # missing values, a missing internal standard is missing for all its compounds of the injection
+        missing = rng.uniform(size=len(measurements)) < self.missing_rate
+        measurements.loc[missing, ['rt', 'area']] = np.nan
+
+        missing_is = (rng.uniform(size=is_response.shape) < self.missing_rate)[:, compound_is].ravel()
+        measurements.loc[missing_is, ['rt_is', 'area_is']] = np.nan
+
+        return measurements[self.columns]
+
+    # write the generated measurements to a measurements file
+    def write_mea_file(self, mea_file):
+
+        measurements = self.generate()
+        measurements.to_csv(mea_file, sep="\t", index=False, encoding='utf-8')
+
+        return len(measurements)
+
+    # *************************************
+    # HELPER FUNCTIONS
+    # *************************************
+
+    # generate the injections of all batches, in order of measurement
+    def generate_injections(self, rng):
+
+        injections = []
+        start = datetime.datetime(2015, 3, 5, 9, 0, 0)
+
+        for batch in range(1, self.batches + 1):
+
+            types = np.array(
+                ['sample'] * self.samples +
+                ['qc'] * int(round(self.qc_ratio * self.samples)) +
+                ['blank'] * int(round(self.blank_ratio * self.samples)) +
+                ['cal'] * int(round(self.cal_ratio * self.samples)), dtype=object)
+
+            # a batch starts with a QC and a blank, the remaining injections are randomized
+            types = np.concatenate([['qc', 'blank'], rng.permutation(types)])
+
+            samples = np.array(['S{:02d}{:05d}'.format(batch, number) for number in range(len(types))], dtype=object)
+            samples[types == 'qc'] = 'QC'
+            samples[types == 'blank'] = 'BLANK'
+            samples[types == 'cal'] = ['CAL{:02d}'.format(level) for level in (np.arange((types == 'cal').sum()) % 7 + 1)]
+
+            batch_injections = pd.DataFrame({
+                'sample': samples,
+                'aliquot': ['{}_b{}_{}'.format(sample, batch, number) for number, sample in enumerate(samples)],
+                'type': types,
+                'injection': 1,
+                'replicate': 'a'
+            })
+
+            # calibration levels increase in concentration, blanks hardly have any signal
+            concentration = rng.lognormal(0, 0.4, len(types))
+            concentration[types == 'qc'] = 1
+            concentration[types == 'blank'] = 0.005
+            concentration[types == 'cal'] = 0.1 * 2.0 ** (np.arange((types == 'cal').sum()) % 7)
+            batch_injections['concentration'] = concentration
+
+            # replicates of study samples are injected again, later in the batch
+            study_samples = np.flatnonzero(types == 'sample')
+            replicates = rng.choice(study_samples, int(round(self.replicate_ratio * len(study_samples))), replace=False)
+            replicate_injections = batch_injections.iloc[np.sort(replicates)].copy()
+            replicate_injections['aliquot'] = replicate_injections['aliquot'] + '_b'
+            replicate_injections['replicate'] = 'b'
+            batch_injections = pd.concat([batch_injections, replicate_injections], ignore_index=True)
+
+            batch_injections['batch'] = batch
+            batch_injections['order'] = np.arange(1, len(batch_injections) + 1)
+            batch_injections['datetime'] = [
+                (start + datetime.timedelta(days=batch - 1, minutes=15 * order)).strftime("%Y-%m-%d %H:%M:%S")
+                for order in batch_injections['order']
+            ]
+
+            injections.append(batch_injections)
+
+        return pd.concat(injections, ignore_index=True)
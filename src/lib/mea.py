@@ -1,22 +1,70 @@
 import os
+import sys
+import json
 import time
-import datetime
+import hashlib
 import pandas as pd
 import numpy as np
 
+# the binary cache is optional, it requires pyarrow
+try:
+    import pyarrow as pa
+    import pyarrow.feather as feather
+except ImportError:
+    feather = None
+
 # collection of features
 class Mea:
 
-    def __init__(self, mea_file=''):
+    # text columns which repeat on every row, these are stored as categoricals
+    categorical_columns = ['sample', 'aliquot', 'type', 'replicate', 'datetime', 'compound', 'compound_is']
+
+    # columns which are indexed by value, for fast slicing
+    index_columns = ['batch', 'compound', 'type', 'compound_is']
+
+    # numeric columns which can be stored in smaller types
+    integer_columns = ['batch', 'order', 'injection']
+    float_columns = ['area', 'rt', 'area_is', 'rt_is']
+
+    # columns derived from other columns, by the columns they are derived from
+    derived_columns = {'timestamp': ['datetime'], 'ratio': ['area', 'area_is']}
+
+    # columns which are always read (when a selection of columns is read), to order the measurements and find those with an area
+    key_columns = ['batch', 'order', 'area']
+
+    # columns read to build the metadata of a measurements file, and the metadata of the unique values of columns
+    metadata_columns = ['batch', 'sample', 'compound', 'compound_is', 'type', 'timestamp']
+    metadata_uniques = {'batch': 'batches', 'compound': 'compounds', 'compound_is': 'internal_standards', 'type': 'types'}
+
+    def __init__(self, mea_file='', cache=False, downcast=False, float32=False, shard_dir='', chunksize=100000,
+                 columns=None, metadata=False):
 
         # init
         self.measurements = None
+        self.pending_columns = []
+        self.finite = None
+        self.finite_measurements = None
+        self.group_values = {}
+        self.group_index = {}
+        self.uniques = {}
+        self.aggregates = {}
+        self.metadata = None
         self.mea_file = None
+        self.batch_files = {}
+        self.load_options = {'cache': cache, 'downcast': downcast, 'float32': float32, 'columns': columns}
 
         # read in settings when provided
         if mea_file != '':
             self.set_mea_file(mea_file)
-            self.read_mea_file(mea_file=self.get_mea_file())
+
+            # split (huge) measurements files into batches instead of reading them at once
+            if shard_dir:
+                self.partition_mea_file(mea_file=self.get_mea_file(), shard_dir=shard_dir, chunksize=chunksize)
+            elif metadata:
+                # only the metadata (batches, samples, compounds, ...), the measurements are not loaded
+                self.load_metadata(mea_file=self.get_mea_file())
+            else:
+                self.read_mea_file(mea_file=self.get_mea_file(), **self.load_options)
 
     # set measurements file
     def set_mea_file(self, mea_file=''):
@@ -26,55 +74,442 @@ class Mea:
     def get_mea_file(self):
         return self.mea_file
 
-    # read in measurements file
-    def read_mea_file(self, mea_file):
+    # get the options used to read measurements files
+    def get_load_options(self):
+        return self.load_options
 
-        try:
+    # set the files with the measurements of each batch
+    def set_batch_files(self, batch_files):
+        self.batch_files = batch_files
 
-            # read raw file
-            self.measurements = pd.read_csv(mea_file, sep="\t")
+    # get the files with the measurements of each batch
+    def get_batch_files(self):
+        return self.batch_files
 
-            # correct some fields
-            self.measurements['compound'] = self.measurements['compound'].apply(lambda name: self.fix_compound_name(name))
+    # split a measurements file into one file per batch, reading chunksize rows at a time
+    def partition_mea_file(self, mea_file, shard_dir, chunksize=100000):
 
-            # add timestamp from datatime
-            try:
-                self.measurements['timestamp'] = self.measurements['datetime'].apply(
-                    lambda x: time.mktime(datetime.datetime.strptime(x, "%Y-%m-%d %H:%M:%S").timetuple()))
-            except:
-                pass
+        os.makedirs(shard_dir, exist_ok=True)
+        batch_files = {}
 
-            try:
-                self.measurements['timestamp'] = self.measurements['datetime'].apply(
-                    lambda x: time.mktime(datetime.datetime.strptime(x, "%Y-%m-%d %H:%M:%S:%f").timetuple()))
-            except:
-                pass
+        # values are kept as text, the batch files hold the rows exactly as they are in the measurements file
+        for chunk in pd.read_csv(mea_file, sep="\t", dtype=str, keep_default_na=False, chunksize=chunksize):
+            for batch, batch_chunk in chunk.groupby(pd.to_numeric(chunk['batch']), sort=False):
+                if batch not in batch_files:
+                    batch_files[batch] = os.path.join(shard_dir, 'batch_{}.tsv'.format(batch))
+                    batch_chunk.to_csv(batch_files[batch], sep="\t", index=False, encoding='utf-8')
+                else:
+                    batch_chunk.to_csv(batch_files[batch], sep="\t", index=False, header=False, mode='a', encoding='utf-8')
 
-            # add ratio to Pandas DataFrame
-            self.measurements['ratio'] = self.measurements['area'] / self.measurements['area_is']
+        self.set_batch_files(batch_files)
+
+    # iterate over the batches of a partitioned measurements file, only one batch is in memory at a time
+    def iter_batches(self):
+
+        for batch in sorted(self.get_batch_files()):
+            yield batch, Mea(mea_file=self.get_batch_files()[batch], **self.get_load_options())
+
+    # read in measurements file, optionally only the columns needed (and the key columns)
+    def read_mea_file(self, mea_file, cache=False, downcast=False, float32=False, columns=None):
+
+        # use the binary cache of the measurements file when it is still valid
+        if not (cache and self.read_cache_file(mea_file, columns=columns)):
+
+            # the binary cache always holds all columns
+            self.parse_mea_file(mea_file, columns=None if cache else columns)
+
+            # (re)build the binary cache for the next time
+            if cache:
+                self.write_cache_file(mea_file)
+                self.select_columns(columns)
+
+        # optionally store numeric columns in smaller types
+        self.downcast_measurements(integers=downcast, floats=float32)
+
+        self.build_index()
+
+    # parse measurements file, optionally only the columns needed (derived columns are then added when first used)
+    def parse_mea_file(self, mea_file, columns=None):
+
+        try:
+
+            usecols = None
+            if columns is not None:
+                header = pd.read_csv(mea_file, sep="\t", nrows=0).columns
+                usecols, self.pending_columns = self.get_source_columns(columns, header)
+
+            # read raw file
+            dtype = {column: 'category' for column in self.categorical_columns}
+            dtype.update({column: np.float64 for column in self.float_columns})
+            self.measurements = pd.read_csv(
+                mea_file, sep="\t", usecols=usecols,
+                dtype={column: dtype[column] for column in dtype if usecols is None or column in usecols})
+
+            # correct some fields (once per unique compound)
+            if 'compound' in self.measurements:
+                self.measurements['compound'] = self.measurements['compound'].map(
+                    lambda name: self.fix_compound_name(name)).astype('category')
+
+            # add timestamp and ratio, unless these are added when first used
+            if columns is None:
+                for column, source_columns in self.derived_columns.items():
+                    if all(source_column in self.measurements for source_column in source_columns):
+                        self.add_derived_column(column)
 
             # sort by batch and injection order
             self.measurements.sort_values(
-                ['batch', 'order'], ascending=[True, True], inplace=True
+                [column for column in ['batch', 'order'] if column in self.measurements], inplace=True
             )
 
             self.measurements.reset_index()
-            self.measurements['position'] = self.measurements.index + 1
+            if columns is None or 'position' in columns:
+                self.measurements['position'] = self.measurements.index + 1
 
         except FileExistsError:
             print("File does not exist!")
 
-    # get measurements as Pandas DataFrame
-    def get_measurements(self, drop_na=True):
+    # store integer columns in the smallest integer type and/or float columns as float32
+    def downcast_measurements(self, integers=True, floats=False):
 
-        if drop_na:
-            return self.measurements[np.isfinite(self.measurements['area'])]
-        else:
-            return self.measurements
+        if self.measurements is None:
+            return
+
+        if integers:
+            for column in self.integer_columns:
+                if column in self.measurements:
+                    self.measurements[column] = pd.to_numeric(self.measurements[column], downcast='integer')
+
+        if floats:
+            for column in self.float_columns:
+                if column in self.measurements:
+                    self.measurements[column] = self.measurements[column].astype(np.float32)
+
+    # get the location of the binary cache of a measurements file
+    def get_cache_file(self, mea_file):
+        return mea_file + '.mzq.feather'
+
+    # identify a measurements file by path, size, modification time and content hash
+    def get_file_key(self, mea_file, content=True):
+
+        stat = os.stat(mea_file)
+
+        file_key = {
+            'path': os.path.abspath(mea_file),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime_ns
+        }
+
+        if content:
+            sha1 = hashlib.sha1()
+            with open(mea_file, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    sha1.update(chunk)
+            file_key['sha1'] = sha1.hexdigest()
+
+        return file_key
+
+    # identify the cached measurements by their file and their layout
+    def get_cache_key(self, mea_file, content=True):
+
+        cache_key = self.get_file_key(mea_file, content=content)
+        cache_key['categorical_columns'] = self.categorical_columns
+
+        return cache_key
+
+    # read the measurements from the binary cache, returns False when it is missing, stale or corrupt
+    def read_cache_file(self, mea_file, columns=None):
+
+        cache_file = self.get_cache_file(mea_file)
+
+        if feather is None:
+            print("Caching requires pyarrow, reading {} instead".format(mea_file), file=sys.stderr)
+            return False
+
+        if not os.path.isfile(cache_file):
+            return False
+
+        try:
+            table = feather.read_table(cache_file, memory_map=True)
+            cache_key = json.loads(table.schema.metadata[b'mzquality'].decode('utf8'))
+
+            # the same size and modification time, or (when touched) the same content
+            file_key = self.get_cache_key(mea_file, content=False)
+            if any(cache_key.get(key) != file_key[key] for key in file_key):
+                if cache_key.get('size') != file_key['size'] or \
+                        cache_key.get('categorical_columns') != file_key['categorical_columns']:
+                    return False
+
+                file_key = self.get_cache_key(mea_file)
+                if cache_key.get('sha1') != file_key['sha1']:
+                    return False
+
+                # store the new modification time, so the content is not hashed again next time (when possible)
+                try:
+                    self.write_cache_table(mea_file, table, file_key)
+                except OSError:
+                    pass
+
+            # only the columns needed are converted
+            if columns is not None:
+                usecols, self.pending_columns = self.get_source_columns(columns, table.column_names, derive=False)
+                table = table.select([column for column in table.column_names
+                                      if column in usecols or column.startswith('__index_level_')])
+
+            self.measurements = table.to_pandas()
+        except Exception:
+            return False
+
+        return True
+
+    # write the measurements to the binary cache, keyed on the measurements file
+    def write_cache_file(self, mea_file):
+
+        if feather is None or self.measurements is None:
+            return False
+
+        return self.write_cache_table(mea_file, pa.Table.from_pandas(self.measurements), self.get_cache_key(mea_file))
+
+    # write a table to the binary cache, with the key of the measurements file in its metadata
+    def write_cache_table(self, mea_file, table, cache_key):
+
+        cache_file = self.get_cache_file(mea_file)
+        cache_tmp_file = "{}.{}.tmp".format(cache_file, os.getpid())
+
+        metadata = dict(table.schema.metadata or {})
+        metadata[b'mzquality'] = json.dumps(cache_key).encode('utf8')
+        table = table.replace_schema_metadata(metadata)
+
+        # write uncompressed so it can be memory mapped, and replace atomically
+        feather.write_feather(table, cache_tmp_file, compression='uncompressed')
+        os.replace(cache_tmp_file, cache_file)
+
+        return True
+
+    # get the location of the metadata of a measurements file
+    def get_metadata_file(self, mea_file):
+        return mea_file + '.mzq.json'
+
+    # get the metadata of the measurements (batches, samples, compounds, internal standards, types, rows and batch times)
+    def get_metadata(self):
+
+        if self.metadata is None:
+            self.metadata = self.build_metadata()
+
+        return self.metadata
+
+    # load the metadata of a measurements file, it is (re)built from a single scan of the file when missing or stale
+    def load_metadata(self, mea_file):
+
+        self.metadata = self.read_metadata_file(mea_file)
+
+        if self.metadata is None:
+            mea = Mea(mea_file=mea_file, cache=self.get_load_options()['cache'], columns=self.metadata_columns)
+            self.metadata = mea.build_metadata(fingerprint=self.get_file_key(mea_file))
+            self.write_metadata_file(mea_file)
+
+        return self.metadata
+
+    # build the metadata of the measurements
+    def build_metadata(self, fingerprint=None):
+
+        measurements = self.get_measurements(drop_na=False)
+
+        metadata = {
+            'fingerprint': fingerprint,
+            'rows': len(measurements),
+            'rows_with_area': len(self.get_measurements()),
+            'samples': self.get_samples().tolist()
+        }
+        for column, key in self.metadata_uniques.items():
+            metadata[key] = self.get_unique(column).tolist() if column in measurements else []
+
+        # rows, samples and first and last injection time of each batch
+        metadata['batch_details'] = {}
+        for batch in metadata['batches']:
+            batch_data = self.get_batch_data(batch=batch, drop_na=False)
+            details = {'rows': len(batch_data), 'samples': self.get_samples(batch=batch).tolist()}
+
+            if 'timestamp' in batch_data and batch_data['timestamp'].notnull().any():
+                details['start'] = str(batch_data['datetime'].loc[batch_data['timestamp'].idxmin()])
+                details['end'] = str(batch_data['datetime'].loc[batch_data['timestamp'].idxmax()])
+
+            metadata['batch_details'][str(batch)] = details
+
+        return metadata
+
+    # read the metadata of a measurements file, returns None when it is missing, stale or corrupt
+    def read_metadata_file(self, mea_file):
+
+        metadata_file = self.get_metadata_file(mea_file)
+
+        if not os.path.isfile(metadata_file):
+            return None
+
+        try:
+            with open(metadata_file) as f:
+                metadata = json.load(f)
+
+            # the same size and modification time, or (when touched) the same content
+            fingerprint = metadata['fingerprint']
+            file_key = self.get_file_key(mea_file, content=False)
+            if any(fingerprint[key] != file_key[key] for key in file_key):
+                if fingerprint['size'] != file_key['size']:
+                    return None
+
+                file_key = self.get_file_key(mea_file)
+                if fingerprint['sha1'] != file_key['sha1']:
+                    return None
+
+                # store the new modification time, so the content is not hashed again next time
+                metadata['fingerprint'] = file_key
+                self.metadata = metadata
+                self.write_metadata_file(mea_file)
+        except Exception:
+            return None
+
+        return metadata
+
+    # write the metadata next to the measurements file
+    def write_metadata_file(self, mea_file):
+
+        metadata_file = self.get_metadata_file(mea_file)
+        metadata_tmp_file = "{}.{}.tmp".format(metadata_file, os.getpid())
+
+        metadata = self.get_metadata()
+        if metadata['fingerprint'] is None:
+            metadata['fingerprint'] = self.get_file_key(mea_file)
+
+        # replace atomically, the metadata is only kept in memory when it can not be written (read-only data)
+        try:
+            with open(metadata_tmp_file, 'w') as f:
+                json.dump(metadata, f)
+            os.replace(metadata_tmp_file, metadata_file)
+        except OSError:
+            if os.path.isfile(metadata_tmp_file):
+                os.remove(metadata_tmp_file)
+            return False
+
+        return True
+
+    # get measurements as Pandas DataFrame, the frame is shared with the index (and other callers) and must not be
+    # changed, use copy=True to get a frame which can be changed (or use set_measurements)
+    def get_measurements(self, drop_na=True, copy=False):
+
+        if self.pending_columns:
+            self.add_pending_columns()
+
+        measurements = self.finite_measurements if drop_na else self.measurements
+
+        return measurements.copy() if copy and measurements is not None else measurements
 
     # set measurements as Pandas DataFrame
     def set_measurements(self, measurements):
         self.measurements = measurements
+        self.pending_columns = []
+        self.build_index()
+
+    # get the columns to read for the columns needed, and the derived columns which are added when first used
+    def get_source_columns(self, columns, available_columns, derive=True):
+
+        available_columns = list(available_columns)
+        source_columns = set(self.key_columns)
+        pending_columns = []
+
+        # derived columns of a measurements file are derived again when possible (like when all columns are read)
+        for column in columns:
+            if derive and column in self.derived_columns and all(
+                    source_column in available_columns for source_column in self.derived_columns[column]):
+                source_columns.update(self.derived_columns[column])
+                pending_columns.append(column)
+            elif column in available_columns:
+                source_columns.add(column)
+
+        return [column for column in available_columns if column in source_columns], pending_columns
+
+    # keep only the columns needed (and the key columns) of the measurements
+    def select_columns(self, columns=None):
+
+        if columns is None or self.measurements is None:
+            return
+
+        usecols, self.pending_columns = self.get_source_columns(columns, self.measurements.columns, derive=False)
+        self.measurements = self.measurements[usecols]
+
+    # add a derived column to the measurements
+    def add_derived_column(self, column):
+
+        if column == 'ratio':
+            self.measurements['ratio'] = self.measurements['area'] / self.measurements['area_is']
+        elif column == 'timestamp':
+            self.measurements['timestamp'] = self.parse_timestamps(self.measurements['datetime'])
+
+    # add the derived columns which were not added when reading the measurements
+    def add_pending_columns(self):
+
+        pending_columns, self.pending_columns = self.pending_columns, []
+        for column in pending_columns:
+            self.add_derived_column(column)
+
+        if self.finite is not None:
+            self.finite_measurements = self.measurements[self.finite]
+
+    # build the index of the measurements, the measurements with an area and the row positions of each
+    # batch, compound, type and internal standard. Unique values are cached when first asked for
+    def build_index(self):
+
+        self.group_values = {}
+        self.group_index = {}
+        self.uniques = {}
+        self.aggregates = {}
+
+        if self.measurements is None:
+            self.finite = None
+            self.finite_measurements = None
+            return
+
+        self.finite = np.isfinite(self.measurements['area'].values)
+        self.finite_measurements = self.measurements[self.finite]
+
+        for column in self.index_columns:
+            if column in self.measurements:
+                codes, values = pd.factorize(self.measurements[column], sort=True)
+
+                # row positions (in order) of each value are consecutive after a stable sort on the codes
+                positions = np.argsort(codes, kind='mergesort')
+                bounds = np.searchsorted(codes[positions], np.arange(len(values) + 1))
+
+                self.group_values[column] = np.asarray(values)
+                self.group_index[column] = {
+                    value: positions[bounds[i]:bounds[i + 1]] for i, value in enumerate(self.group_values[column])
+                }
+
+    # get the row positions of the measurements with a value in an indexed column
+    def get_group_positions(self, column, value, drop_na=True):
+
+        positions = self.group_index[column].get(value, np.array([], dtype=np.intp))
+
+        if drop_na:
+            return positions[self.finite[positions]]
+        else:
+            return positions
+
+    # get the grouped aggregates calculated on the measurements (by Qccalc), they are kept until the measurements are set
+    def get_aggregates(self):
+        return self.aggregates
+
+    # get the sorted unique values of a column of the measurements with an area
+    def get_unique(self, column):
+
+        if column not in self.uniques:
+            if self.measurements is None and self.metadata is not None:
+                self.uniques[column] = np.asarray(self.metadata[self.metadata_uniques[column]])
+            elif column in self.group_index:
+                has_area = [self.finite[positions].any() for positions in self.group_index[column].values()]
+                self.uniques[column] = np.sort(self.group_values[column][np.asarray(has_area, dtype=bool)])
+            else:
+                self.uniques[column] = np.sort(np.asarray(self.get_measurements()[column].unique()))
+
+        return self.uniques[column]
 
     # get measurements of samples measured in replicate
     def get_replicate_measurements(self, drop_na=True):
@@ -87,9 +522,7 @@ class Mea:
     # get the unique types of all measurements
     def get_types(self):
 
-        measurements = self.get_measurements()
-        types = measurements['type'].unique()
-        types.sort()
+        types = self.get_unique('type')
 
         # return sorted list of unique types in measurments
         return types
@@ -97,9 +530,7 @@ class Mea:
     # get the unique batch id's of all measurements
     def get_batches(self):
 
-        measurements = self.get_measurements()
-        batches = measurements['batch'].unique()
-        batches.sort()
+        batches = self.get_unique('batch')
 
         # return sorted batch id's
         return batches
@@ -107,9 +538,7 @@ class Mea:
     # get the unique compounds of all measurements
     def get_compounds(self):
 
-        measurements = self.get_measurements()
-        compounds = measurements['compound'].unique()
-        compounds.sort()
+        compounds = self.get_unique('compound')
 
         # return sorted compounds
         return compounds
@@ -117,9 +546,7 @@ class Mea:
     # get the unique internal standards of all measurements
     def get_internal_standards(self):
 
-        measurements = self.get_measurements()
-        internal_standards = measurements['compound_is'].unique()
-        internal_standards.sort()
+        internal_standards = self.get_unique('compound_is')
 
         # return sorted compounds
         return internal_standards
@@ -127,114 +554,156 @@ class Mea:
     # get the unique samples of all measurements
     def get_samples(self, batch=False):
 
-        if batch != False:
-            measurements = self.get_batch_data(batch=batch)
-        else:
-            measurements = self.get_measurements()
+        if ('sample', batch) not in self.uniques:
+            if self.measurements is None and self.metadata is not None:
+                if batch != False:
+                    samples = self.metadata['batch_details'][str(batch)]['samples']
+                else:
+                    samples = self.metadata['samples']
+            else:
+                if batch != False:
+                    measurements = self.get_batch_data(batch=batch)
+                else:
+                    measurements = self.get_measurements()
+                samples = measurements['sample'].unique()
 
-        return measurements['sample'].unique()
+            self.uniques['sample', batch] = np.asarray(samples)
+
+        return self.uniques['sample', batch]
 
     # get the data of a batch
     def get_batch_data(self, batch, drop_na=True):
 
-        measurements = self.get_measurements(drop_na=drop_na)
-
-        return measurements[measurements['batch'] == batch]
+        return self.get_measurements(drop_na=False).iloc[self.get_group_positions('batch', batch, drop_na=drop_na)]
 
     # get the compound data
     def get_compound_data(self, compound, batch=False, drop_na=True):
 
+        positions = self.get_group_positions('compound', compound, drop_na=drop_na)
         if batch:
-            measurements = self.get_batch_data(batch=batch, drop_na=drop_na)
-        else:
-            measurements = self.get_measurements(drop_na=drop_na)
+            positions = np.intersect1d(positions, self.get_group_positions('batch', batch, drop_na=False), assume_unique=True)
 
-        return measurements[measurements['compound'] == compound]
+        return self.get_measurements(drop_na=False).iloc[positions]
 
     # get the internal standard data
     def get_internal_standard_data(self, internal_standard, batch=False, drop_na=True):
 
+        positions = self.get_group_positions('compound_is', internal_standard, drop_na=drop_na)
         if batch:
-            measurements = self.get_batch_data(batch=batch, drop_na=drop_na)
-        else:
-            measurements = self.get_measurements(drop_na=drop_na)
+            positions = np.intersect1d(positions, self.get_group_positions('batch', batch, drop_na=False), assume_unique=True)
 
-        internal_standard_data = measurements[measurements['compound_is'] == internal_standard]
+        internal_standard_data = self.get_measurements(drop_na=False).iloc[positions]
 
-        return internal_standard_data.groupby('aliquot').first().reset_index()
+        # the first of categorical columns is taken much faster on plain values
+        internal_standard_data = internal_standard_data.astype(
+            {column: object for column in self.categorical_columns if column in internal_standard_data and column != 'aliquot'})
+
+        return internal_standard_data.groupby('aliquot', observed=True).first().reset_index()
 
     # provide data matrix with samples vs features
     def as_table(self, column='area', location='', include_is=False):
 
-        # init
-        sample_feature_lists = {}
-        sample_feature_lists['sample'] = []
-        sample_feature_lists['batch'] = []
+        rows, cols, values = self.get_table_values(column=column, include_is=include_is)
 
-        # prepare header
-        cols = []
-        cols.append('sample')
-        cols.append('batch')
+        data_matrix = pd.DataFrame(values, columns=cols)
+
+        # put sample and batch in first 2 columns
+        data_matrix.insert(0, 'batch', rows['batch'].values)
+        data_matrix.insert(0, 'sample', rows['sample'].values)
+
+        if not location:
+            return data_matrix
+        else:
+            data_matrix.to_csv(location, sep="\t", index=False, encoding='utf-8')
 
-        # add compound names to header
-        for compound in self.get_compounds():
-            cols.append(compound)
+        return True
 
-            if include_is:
-                cols.append(compound + '_IS')
+    # store the samples vs compounds table as float64 matrix (location.npy, which can be loaded with
+    # np.load(mmap_mode='r')) with the samples and batches of the rows and the compounds of the columns in
+    # location.rows.tsv and location.columns.tsv
+    def as_matrix(self, column='area', location='', include_is=False):
 
-            sample_feature_lists[compound] = []
+        rows, cols, values = self.get_table_values(column=column, include_is=include_is)
 
-            if include_is:
-                sample_feature_lists[compound + '_IS'] = []
+        directory = os.path.dirname(location)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        np.save(location + '.npy', np.ascontiguousarray(values, dtype=np.float64))
+        rows.to_csv(location + '.rows.tsv', sep="\t", index=False, encoding='utf-8')
+        pd.DataFrame({'column': cols}).to_csv(location + '.columns.tsv', sep="\t", index=False, encoding='utf-8')
+
+        return [location + '.npy', location + '.rows.tsv', location + '.columns.tsv']
+
+    # *************************************
+    # HELPER FUNCTIONS
+    # *************************************
+
+    # get the values of a column as samples vs compounds matrix, with the rows (sample and batch) and the column names
+    def get_table_values(self, column='area', include_is=False):
 
         measurements = self.get_measurements()
+        compounds = self.get_compounds()
 
-        for batch in self.get_batches():
-            for sample in self.get_samples(batch=batch):  # get batch specific samples
+        # rows are the batch specific samples, by batch and in order of measurement
+        rows = measurements[['batch', 'sample']].drop_duplicates()
+        rows = rows.sort_values('batch', kind='mergesort')
+        row_index = pd.MultiIndex.from_arrays([rows['batch'].values, rows['sample'].values])
 
-                sample_feature_lists['sample'].append(sample)
-                sample_feature_lists['batch'].append(batch)
+        # only the first measurement of each batch, sample and compound is used
+        first = measurements.drop_duplicates(['batch', 'sample', 'compound'])
+        row_positions = row_index.get_indexer(
+            pd.MultiIndex.from_arrays([first['batch'].values, first['sample'].values]))
+        col_positions = pd.Index(compounds).get_indexer(first['compound'])
 
-                for compound in self.get_compounds():
+        # some compounds may not be in all batches, add 0 there
+        values = np.zeros((len(rows), len(compounds)))
+        values[row_positions, col_positions] = first[column].values.astype(float)
 
-                    batch_sample_compound = measurements[
-                        (measurements['batch'] == batch) &
-                        (measurements['sample'] == sample) &
-                        (measurements['compound'] == compound)
-                    ]
+        # prepare header
+        cols = list(compounds)
 
-                    # some compounds may not be in all batches, add 0 there
-                    try:
-                        value = batch_sample_compound.iloc[0][column]
-                    except:
-                        value = 0.0
+        if include_is:
+            values_is = np.zeros((len(rows), len(compounds)))
+            values_is[row_positions, col_positions] = first['area_is'].values.astype(float)
 
-                    if include_is:
-                        try:
-                            value_is = batch_sample_compound.iloc[0]['area_is']
-                        except:
-                            value_is = 0.0
+            # interleave each compound with its internal standard
+            values = np.stack([values, values_is], axis=2).reshape(len(rows), 2 * len(compounds))
+            cols = [col for compound in compounds for col in (compound, compound + '_IS')]
 
-                    # include the value
-                    sample_feature_lists[compound].append(float(value))
+        return rows[['sample', 'batch']], cols, values
 
-                    if include_is:
-                        sample_feature_lists[compound + '_IS'].append(float(value_is))
+    # convert datetimes (with or without milliseconds) to timestamps in local time
+    def parse_timestamps(self, datetimes):
 
-        data_matrix = pd.DataFrame(sample_feature_lists)
-        data_matrix = data_matrix[cols]  # put sample and batch in first 2 columns
+        formats = ["%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M:%S:%f"]
 
-        if not location:
-            return data_matrix
-        else:
-            data_matrix.to_csv(location, sep="\t", index=False, encoding='utf-8')
+        # each distinct datetime is parsed only once
+        codes, uniques = pd.factorize(datetimes)
+        uniques = pd.Series(uniques).astype(str)
 
-        return True
+        # detect the format on the first datetime, the other format is used for what remains (mixed files)
+        if len(uniques) and uniques.iloc[0].count(':') > 2:
+            formats.reverse()
 
-    # *************************************
-    # HELPER FUNCTIONS
-    # *************************************
+        parsed = pd.to_datetime(uniques, format=formats[0], errors='coerce')
+        unparsed = parsed.isnull()
+        if unparsed.any():
+            parsed[unparsed] = pd.to_datetime(uniques[unparsed], format=formats[1], errors='coerce')
+
+        # seconds since epoch, like time.mktime (milliseconds are ignored)
+        timestamps = np.array([
+            time.mktime(value.timetuple()) if not pd.isnull(value) else np.nan for value in parsed
+        ], dtype=np.float64)
+        timestamps = np.append(timestamps, np.nan)[codes]  # code -1 (missing) maps to the appended nan
+
+        # report the rows which could not be parsed (to stderr, stdout may hold the output of a command)
+        unparsed_rows = np.isnan(timestamps)
+        if unparsed_rows.any():
+            print("Could not parse the datetime of {} row(s), e.g. '{}'".format(
+                unparsed_rows.sum(), datetimes.iloc[np.flatnonzero(unparsed_rows)[0]]), file=sys.stderr)
+
+        return timestamps
 
     # correct compound names in measurements
     def fix_compound_name(self, name):
@@ -0,0 +1,182 @@
+import os
+import sys
+import json
+import time
+import atexit
+import inspect
+import threading
+import cProfile
+import functools
+import pandas as pd
+from .mea import Mea
+from .qccalc import Qccalc
+from .qcplot import Qcplot
+
+# the peak RSS is only available on unix
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# CPU time of the calling thread (python 3.7+), stages can run concurrently in threads (run_all), before 3.7 the CPU
+# time of the whole process is used
+thread_time = getattr(time, 'thread_time', time.process_time)
+
+# instrumentation of the stages of mzQuality, methods are only wrapped while it is installed
+class Profiler:
+
+    # methods which are instrumented, by class
+    stages = {
+        Mea: ['read_mea_file', 'as_table'],
+        Qccalc: ['blank_effect', 'rt_shifts', 'qc_correction', 'qc_correction_by_batch_files',
+                 'rsdqc', 'rsdrep', 'rsdis'],
+        Qcplot: ['plot_compound_qc_data'],
+    }
+
+    # arguments which are added to the trace (when given as simple values)
+    traced_arguments = ['mea_file', 'column', 'by_batch', 'compound', 'include_is', 'bootstrap']
+
+    def __init__(self, trace_file='', stats_file=''):
+
+        # init
+        self.trace_file = trace_file  # JSON lines, to stderr when not set
+        self.stats_file = stats_file  # cProfile stats of the slowest stage, when set
+        self.originals = {}
+        self.local = threading.local()  # the depth of the stages of each thread (stages can run concurrently)
+        self.slowest = None
+
+    # get the file the trace is written to
+    def get_trace_file(self):
+        return self.trace_file
+
+    # get the file the cProfile stats of the slowest stage are written to
+    def get_stats_file(self):
+        return self.stats_file
+
+    # wrap the methods of the stages, and write the stats of the slowest stage on exit
+    def install(self):
+
+        for cls, methods in self.stages.items():
+            for method in methods:
+                original = getattr(cls, method)
+                self.originals[cls, method] = original
+                setattr(cls, method, self.instrument(cls.__name__ + '.' + method, original))
+
+        if self.get_stats_file():
+            atexit.register(self.write_stats)
+
+        return self
+
+    # restore the original methods
+    def uninstall(self):
+
+        for (cls, method), original in self.originals.items():
+            setattr(cls, method, original)
+
+        self.originals = {}
+
+    # wrap a method, each call adds a record to the trace
+    def instrument(self, stage, method):
+
+        signature = inspect.signature(method)
+
+        @functools.wraps(method)
+        def instrumented(instance, *args, **kwargs):
+
+            depth = getattr(self.local, 'depth', 0)
+
+            profile = None
+            if self.get_stats_file() and depth == 0:
+                profile = cProfile.Profile()
+
+            rows_in = self.count_rows(instance)
+            rss = self.get_peak_rss()
+            cpu = thread_time()
+            start = time.time()
+            wall = time.perf_counter()
+
+            self.local.depth = depth + 1
+            try:
+                if profile is not None:
+                    profile.enable()
+                result = method(instance, *args, **kwargs)
+            finally:
+                if profile is not None:
+                    profile.disable()
+                self.local.depth = depth
+
+            record = {
+                'stage': stage,
+                'arguments': self.get_arguments(signature.bind_partial(instance, *args, **kwargs).arguments),
+                'pid': os.getpid(),
+                'depth': depth,
+                'start': round(start, 6),
+                'wall': round(time.perf_counter() - wall, 6),
+                'cpu': round(thread_time() - cpu, 6),
+                'peak_rss_delta': None if rss is None else self.get_peak_rss() - rss,
+                'rows_in': rows_in,
+                'rows_out': len(result) if isinstance(result, pd.DataFrame) else self.count_rows(instance)
+            }
+            self.write_record(record)
+
+            # keep the profile of the slowest (outer) stage
+            if profile is not None and (self.slowest is None or record['wall'] > self.slowest[0]['wall']):
+                self.slowest = (record, profile)
+
+            return result
+
+        return instrumented
+
+    # write a record to the trace (appended, so worker processes can write to the same file)
+    def write_record(self, record):
+
+        line = json.dumps(record) + '\n'
+
+        if self.get_trace_file():
+            with open(self.get_trace_file(), 'a') as trace_file:
+                trace_file.write(line)
+        else:
+            sys.stderr.write(line)
+
+    # write the cProfile stats of the slowest stage
+    def write_stats(self):
+
+        if self.slowest is None or os.getpid() != self.slowest[0]['pid']:
+            return False
+
+        self.slowest[1].dump_stats(self.get_stats_file())
+        self.write_record({'stage': 'profile', 'slowest': self.slowest[0]['stage'], 'stats_file': self.get_stats_file()})
+
+        return True
+
+    # *************************************
+    # HELPER FUNCTIONS
+    # *************************************
+
+    # get the peak resident set size of the process in bytes, this is the high-water mark of the whole process: the
+    # delta of a stage only reflects its own memory when no other stages run at the same time (run_all with threads=1)
+    def get_peak_rss(self):
+
+        if resource is None:
+            return None
+
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        # kilobytes, except on macOS
+        return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+    # get the number of measurements an instance works on
+    def count_rows(self, instance):
+
+        mea = instance if isinstance(instance, Mea) else getattr(instance, 'mea', None)
+        measurements = getattr(mea, 'measurements', None)
+
+        return None if measurements is None else len(measurements)
+
+    # get the arguments of a call which are added to the trace
+    def get_arguments(self, arguments):
+
+        return {
+            name: value for name, value in arguments.items()
+            if name in self.traced_arguments and isinstance(value, (str, int, float, bool))
+        }
@@ -2,10 +2,23 @@ import os
 import subprocess
 import pandas as pd
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from .mea import Mea
 
 # collection of features
 class Qccalc:
 
+    # column by which each calculation lists its results when run by batch file, blank effects are listed by batch
+    by_batch_files_sort_columns = {
+        'rt_shifts': 'compound',
+        'rsdqc': 'compound',
+        'rsdrep': 'compound',
+        'rsdis': 'internal_standard'
+    }
+
+    # number of rows resampled at once by the bootstrap (per chunk of resamples)
+    bootstrap_chunk_rows = 250000
+
     def __init__(self, mea=''):
 
         # init
@@ -27,110 +40,120 @@ class Qccalc:
     def blank_effect(self, by_batch=False):
 
         mea = self.get_mea()
-        measurements = mea.get_measurements()
+
+        # all compounds (for each batch)
+        if by_batch:
+            compounds = np.tile(mea.get_compounds(), len(mea.get_batches()))
+            batches = np.repeat(mea.get_batches(), len(mea.get_compounds()))
+            index = pd.MultiIndex.from_arrays([compounds, batches])
+        else:
+            compounds = mea.get_compounds()
+            index = pd.Index(compounds)
+
+        # mean area of the blanks relative to the median area of the samples
+        aggregates = self.get_aggregates(key='compound', by_batch=by_batch)
+        blanks_area_mean = self.get_aggregate(aggregates, 'blank', 'area', 'mean', index).values
+        samples_area_median = self.get_aggregate(aggregates, 'sample', 'area', 'median', index).values
 
         blank_effect = {}
-        blank_effect['compound'] = []
-        blank_effect['be'] = []
-        blank_effect['be_perc'] = []
-
-        if by_batch: # blank effect calculations (by batch)
-
-            # add batch column
-            blank_effect['batch'] = []
-
-            # Do batch specific calculations
-            for batch in mea.get_batches():
-
-                batch_index = measurements[measurements['batch'] == batch]
-
-                # unique batch samples
-                unique_batch_samples = batch_index['sample'].unique()
-                unique_batch_samples.sort()
-
-                # blank effect calculations
-                for compound in mea.get_compounds():
-                    # get all data for this compound
-                    compound_index = batch_index[batch_index['compound'] == compound]
-                    # get compound sample
-                    compound_samples_index = compound_index[compound_index['type'] == 'sample']
-                    # get compound blank
-                    compound_blanks_index = compound_index[compound_index['type'] == 'blank']
-                    # calculate blank effect
-                    be_compound = compound_blanks_index['area'].mean() / compound_samples_index['area'].median()
-                    be_compound_perc = (100 * (compound_blanks_index['area'].mean() / compound_samples_index['area'].median()))
-
-                    # add the columns to the final data frame
-                    blank_effect['compound'].append(compound)
-                    blank_effect['batch'].append(batch)
-                    blank_effect['be'].append(be_compound)
-                    blank_effect['be_perc'].append(be_compound_perc)
-        else: # blank effect calculations (all batches)
-            for compound in mea.get_compounds():
-                # get all data for this compound
-                compound_index = measurements[measurements['compound'] == compound]
-                # get compound sample
-                compound_samples_index = compound_index[compound_index['type'] == 'sample']
-                # get compound blank
-                compound_blanks_index = compound_index[compound_index['type'] == 'blank']
-                # calculate blank effect
-                be_compound = compound_blanks_index['area'].mean() / compound_samples_index['area'].median()
-                be_compound_perc = (100 * (compound_blanks_index['area'].mean() / compound_samples_index['area'].median()))
-
-                # add the columns to the final data frame
-                blank_effect['compound'].append(compound)
-                blank_effect['be'].append(be_compound)
-                blank_effect['be_perc'].append(be_compound_perc)
+        blank_effect['compound'] = compounds
+        blank_effect['be'] = blanks_area_mean / samples_area_median
+        blank_effect['be_perc'] = 100 * (blanks_area_mean / samples_area_median)
+
+        if by_batch:  # add batch column
+            blank_effect['batch'] = batches
 
         return pd.DataFrame(blank_effect).round(decimals=2)
 
-    def qc_correction(self):
+    def qc_correction(self, compound_qc_ratio_medians=None, drift=False, span=0.75):
 
         mea = self.get_mea()
-        measurements = mea.get_measurements()
-        measurements = measurements.copy()
+        measurements = mea.get_measurements(copy=True)
 
         # check if there are any QC samples to use
-        if len(measurements[measurements['type'] == 'qc']) <= 0:
+        if compound_qc_ratio_medians is None and len(measurements[measurements['type'] == 'qc']) <= 0:
             return pd.DataFrame()  # return an empty dataframe
 
-        # compound calculations
-        for compound in measurements['compound'].unique():
+        # only positive ratios of QC samples are used for the medians
+        qc_ratio = measurements['ratio'].where((measurements['type'] == 'qc') & (measurements['ratio'] > 0))
 
-            compound_qc_index = \
-                (measurements['compound'] == compound) & \
-                (measurements['type'] == 'qc') & \
-                (measurements['ratio'] > 0)
-
-            # inter batch qc ratio median
-            compound_qc_ratio_median = measurements[compound_qc_index]['ratio'].median()
-
-            # first do intra batch qc corrections
-            for batch in measurements['batch'].unique():
+        # inter batch qc ratio median (per compound), unless given (i.e. when correcting one batch at a time)
+        if compound_qc_ratio_medians is None:
+            compound_qc_ratio_median = qc_ratio.groupby(measurements['compound'], observed=True).transform('median')
+        else:
+            compound_qc_ratio_median = pd.Series(
+                compound_qc_ratio_medians.reindex(np.asarray(measurements['compound'])).values,
+                index=measurements.index)
 
-                compound_batch_index = \
-                    (measurements['batch'] == batch) & \
-                    (measurements['compound'] == compound)
+        # intra batch qc ratio median (per compound and batch)
+        med_ratio = qc_ratio.groupby(
+            [measurements['compound'], measurements['batch']], observed=True).transform('median')
 
-                compound_qc_batch_index = \
-                    (measurements['batch'] == batch) & \
-                    (measurements['compound'] == compound) & \
-                    (measurements['type'] == 'qc') & \
-                    (measurements['ratio'] > 0)
+        # use median to level/scale ratio
+        qc_correct_factor = compound_qc_ratio_median / med_ratio
 
-                # use median to level/scale ratio
-                med_ratio = measurements[compound_qc_batch_index]['ratio'].median()
-                qc_correct_factor = compound_qc_ratio_median / med_ratio
+        # add column inter_median_qc_corrected with median corrected ratios
+        measurements['inter_median_qc_corrected'] = measurements['ratio'] * qc_correct_factor
 
-                # add column inter_median_qc_corrected with median corrected ratios
-                measurements.ix[compound_batch_index, 'inter_median_qc_corrected'] = measurements['ratio'] * qc_correct_factor
+        # add column qc_corrected with ratios corrected for the drift within each batch, leveled to the inter batch median
+        if drift:
+            measurements['qc_corrected'] = measurements['ratio'] * (compound_qc_ratio_median / self.drift_trends(measurements, qc_ratio, span=span))
 
         # TODO: this schouldn't be required
         # mea.set_measurements(measurements)
 
         return measurements
 
-    def rsdrep(self, by_batch=False):
+    # QC correction of a partitioned Mea, returns a partitioned Mea with the corrected batches in shard_dir
+    def qc_correction_by_batch_files(self, shard_dir, drift=False, span=0.75):
+
+        mea = self.get_mea()
+
+        # first pass, collect the positive QC ratios of all batches for the inter batch medians
+        qc_ratios = []
+        for batch, batch_mea in mea.iter_batches():
+            measurements = batch_mea.get_measurements()
+            qc_index = (measurements['type'] == 'qc') & (measurements['ratio'] > 0)
+            qc_ratios.append(pd.DataFrame({
+                'compound': np.asarray(measurements.loc[qc_index, 'compound']),
+                'ratio': measurements.loc[qc_index, 'ratio'].values
+            }))
+
+        compound_qc_ratio_medians = pd.concat(qc_ratios).groupby('compound')['ratio'].median()
+
+        # second pass, correct and store each batch
+        os.makedirs(shard_dir, exist_ok=True)
+        batch_files = {}
+
+        for batch, batch_mea in mea.iter_batches():
+            qc_corrected = Qccalc(mea=batch_mea).qc_correction(
+                compound_qc_ratio_medians=compound_qc_ratio_medians, drift=drift, span=span)
+
+            batch_files[batch] = os.path.join(shard_dir, 'batch_{}.tsv'.format(batch))
+            qc_corrected.to_csv(batch_files[batch], sep="\t", index=False, encoding='utf-8')
+
+        qc_corrected_mea = Mea(**mea.get_load_options())
+        qc_corrected_mea.set_batch_files(batch_files)
+
+        return qc_corrected_mea
+
+    # run a batch scoped calculation (by_batch=True where applicable) on each batch of a partitioned Mea
+    def by_batch_files(self, calculation, **kwargs):
+
+        results = []
+        for batch, batch_mea in self.get_mea().iter_batches():
+            results.append(getattr(Qccalc(mea=batch_mea), calculation)(**kwargs))
+
+        results = pd.concat(results, ignore_index=True)
+
+        # list the results like the calculation on all measurements does, batches within each compound
+        sort_column = self.by_batch_files_sort_columns.get(calculation)
+        if sort_column in results:
+            results = results.sort_values(sort_column, kind='mergesort').reset_index(drop=True)
+
+        return results
+
+    def rsdrep(self, by_batch=False, bootstrap=0, confidence=0.95, seed=0, workers=1):
 
         rsdrep = {}
         rsdrep['compound'] = []
@@ -149,7 +172,7 @@ class Qccalc:
         if len(measurements) <= 0:
             return pd.DataFrame()  # return an empty dataframe
 
-        for gbkeys, sample_data in measurements.groupby(['compound', 'batch', 'sample', 'injection']):
+        for gbkeys, sample_data in measurements.groupby(['compound', 'batch', 'sample', 'injection'], observed=True):
 
             if len(sample_data) == 2:
                 rsdrep_nc = 100 * (sample_data['area'].std() / sample_data['area'].mean())
@@ -172,16 +195,25 @@ class Qccalc:
             rsdrep_df = pd.DataFrame(rsdrep).groupby(['compound'], as_index=False).mean()
             rsdrep_df = rsdrep_df[['compound', 'rsdrep_inter_median_qc_corrected', 'rsdrep_is_corrected', 'rsdrep_nc']]
 
-        return rsdrep_df.round(decimals=2)
+        # bootstrap interval of the mean of the replicate RSD's
+        if bootstrap:
+            keys = ['compound', 'batch'] if by_batch else ['compound']
+            index = pd.MultiIndex.from_frame(rsdrep_df[keys]) if by_batch else pd.Index(rsdrep_df['compound'])
+            groups = pd.DataFrame(rsdrep)[keys]
+            groups = index.get_indexer(pd.MultiIndex.from_frame(groups) if by_batch else groups['compound'])
 
-    def rsdqc(self, by_batch=False):
+            rsd_columns = ['rsdrep_inter_median_qc_corrected', 'rsdrep_is_corrected', 'rsdrep_nc']
+            lower, upper = self.bootstrap_interval(
+                np.array([rsdrep[rsd_column] for rsd_column in rsd_columns], dtype=float).T, groups, len(index),
+                statistic='mean', bootstrap=bootstrap, confidence=confidence, seed=seed, workers=workers)
 
-        rsdqc = {}
-        rsdqc['compound'] = []
-        rsdqc['batch'] = []
-        rsdqc['rsdqc_nc'] = []
-        rsdqc['rsdqc_is_corrected'] = []
-        rsdqc['rsdqc_inter_median_qc_corrected'] = []
+            for position, rsd_column in enumerate(rsd_columns):
+                rsdrep_df[rsd_column + '_lower'] = lower[:, position]
+                rsdrep_df[rsd_column + '_upper'] = upper[:, position]
+
+        return rsdrep_df.round(decimals=2)
+
+    def rsdqc(self, by_batch=False, bootstrap=0, confidence=0.95, seed=0, workers=1):
 
         mea = self.get_mea()
         measurements = mea.get_measurements()
@@ -190,42 +222,47 @@ class Qccalc:
         if len(measurements[measurements['type'] == 'qc']) <= 0:
             return pd.DataFrame()  # return an empty dataframe
 
-        for compound in mea.get_compounds():
+        # compounds (and batches) with QC samples
+        aggregates = self.get_aggregates(key='compound', by_batch=by_batch)
+        if by_batch:
+            index = pd.MultiIndex.from_arrays([
+                np.repeat(mea.get_compounds(), len(mea.get_batches())),
+                np.tile(mea.get_batches(), len(mea.get_compounds()))
+            ])
+        else:
+            index = pd.Index(mea.get_compounds())
+        index = index[index.isin(self.get_aggregate(aggregates, 'qc', 'area', 'n').index)]
+
+        rsdqc = {}
+        rsdqc['compound'] = index.get_level_values(0)
+
+        if by_batch:
+            rsdqc['batch'] = index.get_level_values(1)
+
+        rsd_columns = [
+            ('rsdqc_nc', 'area'),
+            ('rsdqc_is_corrected', 'ratio'),
+            ('rsdqc_inter_median_qc_corrected', 'inter_median_qc_corrected')
+        ]
+        for rsd_column, column in rsd_columns:
+            rsdqc[rsd_column] = 100 * (self.get_aggregate(aggregates, 'qc', column, 'std', index).values /
+                                       self.get_aggregate(aggregates, 'qc', column, 'mean', index).values)
+
+        # bootstrap interval of the RSD's, the QC injections are resampled
+        if bootstrap:
+            qc = measurements[measurements['type'] == 'qc']
             if by_batch:
-                for batch in mea.get_batches():
-                    compound_batch_qc = measurements[
-                        (measurements['batch'] == batch) &
-                        (measurements['type'] == 'qc') &
-                        (measurements['compound'] == compound)
-                    ]
-
-                    if len(compound_batch_qc) >= 1:
-
-                        rsdqc_nc = 100 * (compound_batch_qc['area'].std() / compound_batch_qc['area'].mean())
-                        rsdqc_is_corrected = 100 * (compound_batch_qc['ratio'].std() / compound_batch_qc['ratio'].mean())
-                        rsdqc_inter_median_qc_corrected = 100 * (compound_batch_qc['inter_median_qc_corrected'].std() / compound_batch_qc['inter_median_qc_corrected'].mean())
-
-                        rsdqc['compound'].append(compound)
-                        rsdqc['batch'].append(batch)
-                        rsdqc['rsdqc_nc'].append(rsdqc_nc)
-                        rsdqc['rsdqc_is_corrected'].append(rsdqc_is_corrected)
-                        rsdqc['rsdqc_inter_median_qc_corrected'].append(rsdqc_inter_median_qc_corrected)
+                groups = index.get_indexer(pd.MultiIndex.from_arrays([np.asarray(qc['compound']), qc['batch'].values]))
             else:
-                rsdqc.pop('batch', None)
-                compound_qc = measurements[
-                    (measurements['type'] == 'qc') &
-                    (measurements['compound'] == compound)
-                    ]
-
-                if len(compound_qc) >= 1:
-                    rsdqc_nc = 100 * (compound_qc['area'].std() / compound_qc['area'].mean())
-                    rsdqc_is_corrected = 100 * (compound_qc['ratio'].std() / compound_qc['ratio'].mean())
-                    rsdqc_inter_median_qc_corrected = 100 * (compound_qc['inter_median_qc_corrected'].std() / compound_qc['inter_median_qc_corrected'].mean())
-
-                    rsdqc['compound'].append(compound)
-                    rsdqc['rsdqc_nc'].append(rsdqc_nc)
-                    rsdqc['rsdqc_is_corrected'].append(round(rsdqc_is_corrected, 2))
-                    rsdqc['rsdqc_inter_median_qc_corrected'].append(round(rsdqc_inter_median_qc_corrected, 2))
+                groups = index.get_indexer(np.asarray(qc['compound']))
+
+            lower, upper = self.bootstrap_interval(
+                qc[[column for rsd_column, column in rsd_columns]].values.astype(float), groups, len(index),
+                statistic='rsd', bootstrap=bootstrap, confidence=confidence, seed=seed, workers=workers)
+
+            for position, (rsd_column, column) in enumerate(rsd_columns):
+                rsdqc[rsd_column + '_lower'] = lower[:, position]
+                rsdqc[rsd_column + '_upper'] = upper[:, position]
 
         return pd.DataFrame(rsdqc).round(decimals=2)
 
@@ -233,64 +270,230 @@ class Qccalc:
 
         mea = self.get_mea()
 
+        # all internal standards (and batches with data of the internal standard)
+        aggregates = self.get_aggregates(key='internal_standard', by_batch=by_batch)
+        if by_batch:
+            index = pd.MultiIndex.from_arrays([
+                np.repeat(mea.get_internal_standards(), len(mea.get_batches())),
+                np.tile(mea.get_batches(), len(mea.get_internal_standards()))
+            ])
+            index = index[index.isin(aggregates.index.droplevel('type'))]
+        else:
+            index = pd.Index(mea.get_internal_standards())
+
         rsdis = {}
-        rsdis['internal_standard'] = []
-        rsdis['rsdis_samples'] = []
-        rsdis['rsdis_qc'] = []
+        rsdis['internal_standard'] = index.get_level_values(0)
+        rsdis['rsdis_samples'] = 100 * (self.get_aggregate(aggregates, 'sample', 'area_is', 'std', index).values /
+                                        self.get_aggregate(aggregates, 'sample', 'area_is', 'mean', index).values)
+        rsdis['rsdis_qc'] = 100 * (self.get_aggregate(aggregates, 'qc', 'area_is', 'std', index).values /
+                                   self.get_aggregate(aggregates, 'qc', 'area_is', 'mean', index).values)
 
         if by_batch:  # keep track of batch
-            rsdis['batch'] = []
+            rsdis['batch'] = index.get_level_values(1)
 
-        for internal_standard in mea.get_internal_standards():
-            if by_batch:
-                for batch in mea.get_batches():
-                    batch_is_data = mea.get_internal_standard_data(internal_standard=internal_standard, batch=batch)
-
-                    if len(batch_is_data):
-                        rsdis['internal_standard'].append(internal_standard)
-                        rsdis['batch'].append(batch)
-                        rsdis['rsdis_samples'].append(100 * (batch_is_data[batch_is_data['type'] == 'sample']['area_is'].std() / batch_is_data[batch_is_data['type'] == 'sample']['area_is'].mean()))
-                        rsdis['rsdis_qc'].append(100 * (batch_is_data[batch_is_data['type'] == 'qc']['area_is'].std() / batch_is_data[batch_is_data['type'] == 'qc']['area_is'].mean()))
-            else:
-                is_data = mea.get_internal_standard_data(internal_standard=internal_standard)
+        return pd.DataFrame(rsdis).round(decimals=2)
 
-                rsdis['internal_standard'].append(internal_standard)
-                rsdis['rsdis_samples'].append(100 * (is_data[is_data['type'] == 'sample']['area_is'].std() / is_data[is_data['type'] == 'sample']['area_is'].mean()))
-                rsdis['rsdis_qc'].append(100 * (is_data[is_data['type'] == 'qc']['area_is'].std() / is_data[is_data['type'] == 'qc']['area_is'].mean()))
+    # rt shifts of each compound per batch, of the compound (rt) or of its internal standard (rt_is)
+    def rt_shifts(self, column='rt'):
 
-        return pd.DataFrame(rsdis).round(decimals=2)
+        mea = self.get_mea()
+        measurements = mea.get_measurements()
 
+        # only the columns needed, ordered by compound and batch (stable, keeps the injection order)
+        rt_shifts = pd.DataFrame({
+            'compound': np.asarray(measurements['compound']),
+            'batch': measurements['batch'].values,
+            'sample': np.asarray(measurements['sample']),
+            column: measurements[column].values
+        })
+        rt_shifts = rt_shifts.sort_values(['compound', 'batch'], kind='mergesort').reset_index(drop=True)
+
+        # mean, (population) standard deviation and shift of each compound and batch, as columns
+        groups = [rt_shifts['compound'], rt_shifts['batch']]
+        rt_mean = rt_shifts[column].groupby(groups, sort=False).transform('mean')
+        rt_shift = rt_shifts[column] - rt_mean
+
+        rt_shifts[column + '_mean'] = rt_mean
+        rt_shifts[column + '_stdev'] = np.sqrt((rt_shift ** 2).groupby(groups, sort=False).transform('mean'))
+        rt_shifts[column + '_shift'] = rt_shift
+
+        return rt_shifts.drop(columns=column)
+
+    # *************************************
+    # HELPER FUNCTIONS
+    # *************************************
+
+    # get the trend of the QC ratios over the injection order of each injection, by compound and batch. The trend is a
+    # LOESS fit (tricube weighted local linear regression on the span nearest QC's), for all compounds of a batch at once
+    def drift_trends(self, measurements, qc_ratio, span=0.75):
+
+        trends = np.full(len(measurements), np.nan)
+
+        compounds = pd.factorize(np.asarray(measurements['compound']))[0]
+        orders = measurements['order'].values.astype(float)
+        qc_ratio = qc_ratio.values
+        batches = measurements['batch'].values
+
+        for batch in pd.unique(batches):
+            rows = np.flatnonzero(batches == batch)
+            qc_rows = rows[np.isfinite(qc_ratio[rows])]
+            if len(qc_rows) == 0:
+                continue
+
+            # the QC ratios in a matrix of compounds by QC injection (order)
+            batch_compounds, compound_index = np.unique(compounds[rows], return_inverse=True)
+            qc_orders = np.unique(orders[qc_rows])
+            ratios = np.zeros((len(batch_compounds), len(qc_orders)))
+            used = np.zeros(ratios.shape)
+            qc_compounds = np.searchsorted(batch_compounds, compounds[qc_rows])
+            qc_positions = np.searchsorted(qc_orders, orders[qc_rows])
+            ratios[qc_compounds, qc_positions] = qc_ratio[qc_rows]
+            used[qc_compounds, qc_positions] = 1
+
+            # tricube weights of the QC's of each compound for each injection (order), within the distance of the span
+            # nearest QC's of the compound
+            batch_orders, order_index = np.unique(orders[rows], return_inverse=True)
+            distances = qc_orders[np.newaxis, :] - batch_orders[:, np.newaxis]
+            absolute_distances = np.where(used[:, np.newaxis, :] > 0, np.abs(distances), np.inf)
+
+            n_qc = used.sum(axis=1).astype(int)
+            nearest = np.minimum(n_qc, np.maximum(2, np.ceil(span * n_qc).astype(int)))
+            bandwidth = np.take_along_axis(np.sort(absolute_distances, axis=2), np.maximum(nearest - 1, 0)[:, np.newaxis, np.newaxis], axis=2)
+            bandwidth = np.maximum(bandwidth, 1) * 1.000001
+            weights = used[:, np.newaxis, :] * (1 - np.clip(absolute_distances / bandwidth, 0, 1) ** 3) ** 3
+
+            # weighted sums of the local linear regressions of all compounds and injections
+            s0 = weights.sum(axis=2)
+            s1 = (weights * distances).sum(axis=2)
+            s2 = (weights * distances ** 2).sum(axis=2)
+            t0 = np.einsum('ceq,cq->ce', weights, ratios)
+            t1 = np.einsum('ceq,cq->ce', weights * distances, ratios)
+
+            with np.errstate(divide='ignore', invalid='ignore'):
+                determinant = s0 * s2 - s1 ** 2
+                fit = np.where(determinant > 1e-9 * s0 * s2, (s2 * t0 - s1 * t1) / determinant, t0 / s0)
+
+            trends[rows] = fit[compound_index, order_index]
+
+        # injections without a (positive) trend are not corrected for drift, but leveled with the batch median
+        batch_median = pd.Series(qc_ratio).groupby([compounds, batches]).transform('median').values
+        trends = np.where(trends > 0, trends, batch_median)
+
+        return pd.Series(trends, index=measurements.index)
+
+    # get the aggregates (n, mean, std and median) of the measurements by compound or internal standard, (batch) and type,
+    # each grouping is calculated once for the measurements of mea and shared by all calculations on them
+    def get_aggregates(self, key='compound', by_batch=False):
+
+        aggregates = self.get_mea().get_aggregates()
+        if (key, by_batch) not in aggregates:
+            aggregates[(key, by_batch)] = self.calculate_aggregates(key=key, by_batch=by_batch)
+
+        return aggregates[(key, by_batch)]
+
+    # calculate the aggregates of all columns of the measurements in a single grouped pass (one groupby().agg)
+    def calculate_aggregates(self, key='compound', by_batch=False):
+
+        measurements = self.get_mea().get_measurements()
+
+        if key == 'internal_standard':
+
+            # an internal standard is measured once per aliquot (the first is used)
+            aliquot_keys = ['compound_is', 'batch', 'aliquot'] if by_batch else ['compound_is', 'aliquot']
+            measurements = measurements[aliquot_keys].assign(
+                type=np.asarray(measurements['type']),
+                area_is=measurements['area_is']
+            ).groupby(aliquot_keys, observed=True).first().reset_index()
+
+            measurements = measurements.rename(columns={'compound_is': 'internal_standard'})
+            columns = ['area_is']
+        else:
+            columns = [column for column in ['area', 'ratio', 'area_is', 'inter_median_qc_corrected']
+                       if column in measurements]
 
-    def rt_shifts(self):
+        keys = [key, 'batch', 'type'] if by_batch else [key, 'type']
+        aggregates = measurements.groupby(keys, observed=True)[columns].agg(['count', 'mean', 'std', 'median'])
 
-        rt_shifts = {}
-        rt_shifts['compound'] = []
-        rt_shifts['batch'] = []
-        rt_shifts['sample'] = []
-        rt_shifts['rt_mean'] = []
-        rt_shifts['rt_stdev'] = []
-        rt_shifts['rt_shift'] = []
+        return aggregates.rename(columns={'count': 'n'}, level=1)
 
-        mea = self.get_mea()
-        measurements = mea.get_measurements()
+    # bootstrap percentile intervals of the RSD (or mean) of each column of values per group, all groups are resampled at once
+    def bootstrap_interval(self, values, groups, n_groups, statistic='rsd', bootstrap=1000, confidence=0.95, seed=0, workers=1):
+
+        # the rows of each group (values of a column can be missing) are resampled together
+        values = values[groups >= 0]
+        groups = groups[groups >= 0]
+        order = np.argsort(groups, kind='mergesort')
+        values, groups = values[order], groups[order]
+
+        counts = np.bincount(groups, minlength=n_groups)
+        finite_counts = np.stack([np.bincount(groups, weights=np.isfinite(column), minlength=n_groups) for column in values.T], axis=1)
+
+        # resamples are drawn in chunks with their own seed, the result does not depend on the number of workers
+        chunk_size = max(1, min(bootstrap, self.bootstrap_chunk_rows // max(len(values), 1)))
+        chunks = [(values, counts, statistic, [seed, chunk], min(chunk_size, bootstrap - start))
+                  for chunk, start in enumerate(range(0, bootstrap, chunk_size))]
+
+        if workers > 1 and len(chunks) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                resamples = list(executor.map(bootstrap_task, *zip(*chunks)))
+        else:
+            resamples = [bootstrap_task(*chunk) for chunk in chunks]
+        resamples = np.concatenate(resamples)
+
+        # percentiles of the groups with enough values
+        lower = np.full(finite_counts.shape, np.nan)
+        upper = np.full(finite_counts.shape, np.nan)
+        valid = finite_counts >= (2 if statistic == 'rsd' else 1)
+        if valid.any():
+            alpha = 100 * (1 - confidence) / 2
+            lower[valid], upper[valid] = np.nanpercentile(resamples[:, valid], [alpha, 100 - alpha], axis=0)
+
+        return lower, upper
+
+    # get an aggregate of a column for one type of measurements, optionally for the keys in index
+    def get_aggregate(self, aggregates, type, column, statistic, index=None):
+
+        aggregate = aggregates.loc[aggregates.index.get_level_values('type') == type, (column, statistic)]
+        aggregate.index = aggregate.index.droplevel('type')
+
+        if index is not None:
+            aggregate = aggregate.reindex(index)
+
+        return aggregate
+
+
+# RSD's (or means) of resamples of the rows of each group (values are sorted on group, with counts rows per group)
+def bootstrap_task(values, counts, statistic, seed, resamples):
+
+    rng = np.random.default_rng(seed)
+    statistics = np.full((resamples, len(counts), values.shape[1]), np.nan)
+
+    # groups without rows are left out
+    present = counts > 0
+    counts = counts[present]
+    starts = np.cumsum(counts) - counts
+
+    # draw (with replacement) from the rows of each group, the same rows for each column
+    draws = np.repeat(starts, counts) + (rng.random((resamples, len(values))) * np.repeat(counts, counts)).astype(np.intp)
+
+    for position, column in enumerate(values.T):
+
+        # missing values are not used, like in the RSD's of the measurements, values are centered on the mean of
+        # their group so the variance can be calculated in one pass
+        finite = np.isfinite(column)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            center = np.add.reduceat(np.where(finite, column, 0), starts) / np.add.reduceat(finite, starts)
+        centered = np.where(finite, column - np.repeat(center, counts), 0)
+
+        samples = np.take(centered, draws)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            n = np.add.reduceat(np.take(finite, draws), starts, axis=1)
+            mean = np.add.reduceat(samples, starts, axis=1) / n
+            if statistic == 'mean':
+                statistics[:, present, position] = center + mean
+                continue
+
+            variance = (np.add.reduceat(samples * samples, starts, axis=1) - n * mean * mean) / (n - 1)
+            statistics[:, present, position] = 100 * (np.sqrt(np.maximum(variance, 0)) / (center + mean))
 
-        for compound in mea.get_compounds():
-            for batch in mea.get_batches():
-                compound_batch = measurements[
-                    (measurements['batch'] == batch) &
-                    (measurements['compound'] == compound)
-                ]
-
-                if len(compound_batch) >= 1:
-                    rt_mean = np.mean(compound_batch['rt'])
-                    rt_stdev = np.std(compound_batch['rt'])
-
-                    for idx, c in compound_batch.iterrows():
-                        rt_shifts['compound'].append(compound)
-                        rt_shifts['batch'].append(batch)
-                        rt_shifts['sample'].append(c['sample'])
-                        rt_shifts['rt_mean'].append(rt_mean)
-                        rt_shifts['rt_stdev'].append(rt_stdev)
-                        rt_shifts['rt_shift'].append(c['rt'] - rt_mean)
-
-        return pd.DataFrame(rt_shifts)
+    return statistics
@@ -1,16 +1,52 @@
 import os
+import html
+import json
+import multiprocessing
 import numpy as np
 from plotly import tools
 from plotly.offline import plot
+from plotly.offline.offline import get_plotlyjs
+from plotly.utils import PlotlyJSONEncoder
 import plotly.graph_objs as go
+from .mea import Mea
 
 # collection of features
 class Qcplot:
 
-    def __init__(self, mea=''):
+    # columns of the measurements used by the plots
+    columns = ['sample', 'aliquot', 'type', 'batch', 'compound', 'area', 'area_is', 'ratio',
+               'inter_median_qc_corrected', 'rt', 'rt_is']
+
+    # plotly.js, when shared by the plots in a location
+    plotlyjs_file = 'plotly.min.js'
+
+    # html page for plots without embedded plotly.js
+    html_page = '''<html>
+<head><meta charset="utf-8" /><title>{title}</title>{head}</head>
+<body>{body}</body>
+</html>
+'''
+
+    # body of the single page report, the figure of the selected compound is parsed and drawn on demand
+    html_report = '''<select id="compound" onchange="showFigure(this.value)">
+{options}
+</select>
+<div id="plot" style="height: 100%; width: 100%;"></div>
+{figures}
+<script type="text/javascript">
+function showFigure(id) {{
+    var figure = JSON.parse(document.getElementById(id).textContent);
+    Plotly.newPlot('plot', figure.data, figure.layout, {{showLink: false}});
+}}
+showFigure(document.getElementById('compound').value);
+</script>
+'''
+
+    def __init__(self, mea='', batches=None):
 
         # init
         self.mea = None
+        self.batches = batches
 
         # read in settings when provided
         if mea != '':
@@ -24,6 +60,14 @@ class Qcplot:
     def get_mea(self):
         return self.mea
 
+    # get the batches of the study (colors are assigned by batch)
+    def get_batches(self):
+
+        if self.batches is None:
+            return self.get_mea().get_batches()
+
+        return self.batches
+
     # get color maps
     def get_colormap(self, level=0):
 
@@ -35,7 +79,8 @@ class Qcplot:
         return list(reversed(colormap[level]))
 
 
-    def plot_compound_qc_data(self, compound=False, location=''):
+    # build the QC figure of a compound
+    def get_compound_qc_figure(self, compound=False):
 
         # load data
         mea = self.get_mea()
@@ -49,12 +94,6 @@ class Qcplot:
         blank_measurements = meas[meas['type'] == 'blank']
         qc_measurements = meas[meas['type'] == 'qc']
 
-        # prepare location
-        try:
-            os.mkdir(location)
-        except:
-            pass
-
         row = 1
         fig = tools.make_subplots(rows=3, cols=1,
                                   vertical_spacing=0.025,
@@ -84,7 +123,7 @@ class Qcplot:
         ), row, 1)
 
         colormap = self.get_colormap(level=0)
-        colormap = colormap[::int(len(colormap)/len(mea.get_batches())-1)]
+        colormap = colormap[::int(len(colormap)/len(self.get_batches())-1)]
         for batch, batch_sample_mea in sample_batch_measurements:
             fig.append_trace(go.Scatter(
                     x=batch_sample_mea['aliquot'],
@@ -146,7 +185,7 @@ class Qcplot:
         ), row, 1)
 
         colormap = self.get_colormap(level=1)
-        colormap = colormap[::int(len(colormap)/len(mea.get_batches())-1)]
+        colormap = colormap[::int(len(colormap)/len(self.get_batches())-1)]
         for batch, batch_sample_mea in sample_batch_measurements:
             fig.append_trace(go.Scatter(
                 x=batch_sample_mea['aliquot'],
@@ -157,7 +196,7 @@ class Qcplot:
             ), row, 1)
 
         colormap = self.get_colormap(level=2)
-        colormap = colormap[::int(len(colormap)/len(mea.get_batches())-1)]
+        colormap = colormap[::int(len(colormap)/len(self.get_batches())-1)]
         for batch, batch_sample_mea in sample_batch_measurements:
             fig.append_trace(go.Scatter(
                 x=batch_sample_mea['aliquot'],
@@ -200,7 +239,111 @@ class Qcplot:
                 width=1)
         ), row, 1)
 
+        return fig
+
+    # plot the QC figure of a compound, with plotly.js embedded or shared with the other plots in location
+    def plot_compound_qc_data(self, compound=False, location='', plotlyjs='embed'):
+
+        fig = self.get_compound_qc_figure(compound=compound)
+
+        # prepare location
+        try:
+            os.mkdir(location)
+        except:
+            pass
+
         plot_location = "{}/{}.html".format(location, compound)
-        plot(fig, filename=plot_location, auto_open=False, show_link=False)
 
-        return plot_location
\ No newline at end of file
+        if plotlyjs == 'shared':
+            self.write_plotlyjs(location=location)
+            with open(plot_location, 'w', encoding='utf-8') as f:
+                f.write(self.html_page.format(
+                    title=html.escape(str(compound)),
+                    head='<script src="{}"></script>'.format(self.plotlyjs_file),
+                    body=plot(fig, output_type='div', include_plotlyjs=False, show_link=False)
+                ))
+        else:
+            plot(fig, filename=plot_location, auto_open=False, show_link=False)
+
+        return plot_location
+
+    # write plotly.js to location, to be shared by all plots there
+    def write_plotlyjs(self, location=''):
+
+        plotlyjs_location = os.path.join(location, self.plotlyjs_file)
+
+        if not os.path.isfile(plotlyjs_location):
+            tmp_location = "{}.{}.tmp".format(plotlyjs_location, os.getpid())
+            with open(tmp_location, 'w', encoding='utf-8') as f:
+                f.write(get_plotlyjs())
+            os.replace(tmp_location, plotlyjs_location)
+
+        return plotlyjs_location
+
+    # plot the QC figures of compounds in a single page, with plotly.js embedded once and figures drawn on demand
+    def plot_compounds_report(self, compounds, report_file):
+
+        options = []
+        figures = []
+        for i, compound in enumerate(compounds):
+            figure = self.get_compound_qc_figure(compound=compound)
+            figure = json.dumps({'data': figure['data'], 'layout': figure['layout']},
+                                cls=PlotlyJSONEncoder, separators=(',', ':'))
+
+            options.append('<option value="figure-{}">{}</option>'.format(i, html.escape(str(compound))))
+            figures.append('<script type="application/json" id="figure-{}">{}</script>'.format(
+                i, figure.replace('</', '<\\/')))
+
+        with open(report_file, 'w', encoding='utf-8') as f:
+            f.write(self.html_page.format(
+                title='mzQuality results',
+                head='<script type="text/javascript">{}</script>'.format(get_plotlyjs()),
+                body=self.html_report.format(options='\n'.join(options), figures='\n'.join(figures))
+            ))
+
+        return report_file
+
+    # plot compounds using a pool of worker processes, each worker only gets the measurements of its compounds, use
+    # start_method='spawn' when other threads are running (forking a process with threads can deadlock)
+    def plot_compounds(self, compounds, location='', workers=1, plotlyjs='embed', start_method=None):
+
+        if workers <= 1:
+            return [self.plot_compound_qc_data(compound=compound, location=location, plotlyjs=plotlyjs)
+                    for compound in compounds]
+
+        measurements = self.get_mea().get_measurements()
+        measurements = measurements[measurements['compound'].isin(compounds)]
+        compound_measurements = dict(list(measurements.groupby('compound', observed=True)))
+
+        # divide the compounds over the workers, in order
+        tasks = []
+        for worker in range(workers):
+            worker_compounds = compounds[worker::workers]
+            if len(worker_compounds):
+                tasks.append((
+                    [(compound, compound_measurements[compound]) for compound in worker_compounds],
+                    self.get_batches(),
+                    location,
+                    plotlyjs
+                ))
+
+        with multiprocessing.get_context(start_method).Pool(processes=workers) as pool:
+            plot_locations = pool.map(plot_compounds_task, tasks)
+
+        # return the plot locations in the order of the compounds
+        return [plot_locations[i % workers][i // workers] for i in range(len(compounds))]
+
+
+# plot the compounds of one worker, the measurements of each compound are plotted with their own Mea
+def plot_compounds_task(task):
+
+    compound_measurements, batches, location, plotlyjs = task
+
+    plot_locations = []
+    for compound, measurements in compound_measurements:
+        mea = Mea()
+        mea.set_measurements(measurements)
+        plot_locations.append(Qcplot(mea=mea, batches=batches).plot_compound_qc_data(
+            compound=compound, location=location, plotlyjs=plotlyjs))
+
+    return plot_locations
@@ -0,0 +1,354 @@
+import os
+import json
+import threading
+import collections
+import pandas as pd
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qsl
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from .mea import Mea
+from .qccalc import Qccalc
+from .qcplot import Qcplot
+
+# an operation which the service does not have
+class UnknownOperationError(LookupError):
+    pass
+
+
+# HTTP server which handles each request in a thread (http.server.ThreadingHTTPServer is only in python 3.7+)
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+
+    # requests which are still running do not keep the service from stopping
+    daemon_threads = True
+
+
+# a loaded study (measurements file), with the results derived from it
+class Study:
+
+    def __init__(self, mea_file, **load_options):
+
+        # init
+        self.mea = Mea(mea_file=mea_file, **load_options)
+        self.qccalc = Qccalc(mea=self.mea)
+        self.qc_corrected = None
+        self.results = {}
+        self.lock = threading.RLock()
+        self.memory_usage = 0
+
+        self.update_memory_usage()
+
+    # get the measurements
+    def get_mea(self):
+        return self.mea
+
+    # get the calculations on the measurements
+    def get_qccalc(self):
+        return self.qccalc
+
+    # get the calculations on the QC corrected measurements (qc corrected files are used as they are)
+    def get_qc_corrected(self):
+
+        with self.lock:
+            if self.qc_corrected is None:
+                if 'inter_median_qc_corrected' in self.get_mea().get_measurements(drop_na=False):
+                    self.qc_corrected = self.get_qccalc()
+                else:
+                    mea = Mea()
+                    mea.set_measurements(self.get_qccalc().qc_correction())
+                    self.qc_corrected = Qccalc(mea=mea)
+                self.update_memory_usage()
+
+        return self.qc_corrected
+
+    # get the result of a calculation, calculated once
+    def get_result(self, name, calculation):
+
+        with self.lock:
+            if name not in self.results:
+                self.results[name] = calculation()
+                self.update_memory_usage()
+
+        return self.results[name]
+
+    # get the (estimated) memory used by the study
+    def get_memory_usage(self):
+        return self.memory_usage
+
+    # estimate the memory used by the measurements and the results
+    def update_memory_usage(self):
+
+        frames = [self.get_mea().get_measurements(drop_na=False)]
+        if self.qc_corrected is not None and self.qc_corrected is not self.qccalc:
+            frames.append(self.qc_corrected.get_mea().get_measurements(drop_na=False))
+        frames.extend(result for result in self.results.values() if isinstance(result, pd.DataFrame))
+
+        self.memory_usage = int(sum(frame.memory_usage(deep=True).sum() for frame in frames))
+
+
+# least recently used cache of studies, keyed on the identity of their file and limited in memory
+class Studycache:
+
+    def __init__(self, memory_limit=1024, **load_options):
+
+        # init
+        self.memory_limit = int(memory_limit * 1024 ** 2)  # in MB
+        self.load_options = load_options
+        self.studies = collections.OrderedDict()
+        self.loading = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # get the identity of a file, a changed file is a different study
+    def get_file_key(self, mea_file):
+
+        stat = os.stat(mea_file)
+
+        return os.path.abspath(mea_file), stat.st_size, stat.st_mtime_ns
+
+    # get a study, loading it when it is not in the cache (each file is loaded once, also by concurrent requests)
+    def get_study(self, mea_file):
+
+        key = self.get_file_key(mea_file)
+
+        with self.lock:
+            if key in self.studies:
+                self.studies.move_to_end(key)
+                self.hits += 1
+                return self.studies[key]
+
+            loading = self.loading.setdefault(key, threading.Lock())
+
+        with loading:
+            with self.lock:
+                if key in self.studies:
+                    self.hits += 1
+                    return self.studies[key]
+
+                self.misses += 1
+
+            try:
+                study = Study(mea_file, **self.load_options)
+            finally:
+                with self.lock:
+                    self.loading.pop(key, None)
+
+            with self.lock:
+                # an older version of the same file is not used anymore
+                for old_key in [old_key for old_key in self.studies if old_key[0] == key[0]]:
+                    del self.studies[old_key]
+
+                self.studies[key] = study
+
+        self.evict()
+
+        return study
+
+    # remove the least recently used studies until the cache fits in memory (the last study is kept)
+    def evict(self):
+
+        with self.lock:
+            while len(self.studies) > 1 and self.get_memory_usage() > self.memory_limit:
+                self.studies.popitem(last=False)
+
+    # get the memory used by the cached studies
+    def get_memory_usage(self):
+        return sum(study.get_memory_usage() for study in list(self.studies.values()))
+
+    # get the status of the cache
+    def get_status(self):
+
+        with self.lock:
+            return {
+                'studies': [{'mea_file': key[0], 'memory_usage': study.get_memory_usage()}
+                            for key, study in self.studies.items()],
+                'memory_usage': self.get_memory_usage(),
+                'memory_limit': self.memory_limit,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+    # remove all studies
+    def clear(self):
+
+        with self.lock:
+            self.studies.clear()
+
+
+# local HTTP/JSON service with the operations of the CLI, on studies which stay loaded
+class Qcserver:
+
+    def __init__(self, host='127.0.0.1', port=8080, memory_limit=1024, **load_options):
+
+        # init
+        self.host = host
+        self.port = port
+        self.studycache = Studycache(memory_limit=memory_limit, **load_options)
+        self.operations = {
+            'summary': self.summary,
+            'blank_effect': self.blank_effect,
+            'rt_shifts': self.rt_shifts,
+            'qc_correction': self.qc_correction,
+            'qc_rsd': self.qc_rsd,
+            'rep_rsd': self.rep_rsd,
+            'internal_standard_rsd': self.internal_standard_rsd,
+            'export': self.export,
+            'plot_compound': self.plot_compound,
+        }
+
+    # get the cache of the studies
+    def get_studycache(self):
+        return self.studycache
+
+    # run an operation, the results are returned or saved in output_file
+    def run(self, operation, mea_file, output_file='', **arguments):
+
+        if operation not in self.operations:
+            raise UnknownOperationError("Unknown operation '{}'".format(operation))
+
+        study = self.get_studycache().get_study(mea_file)
+        result = self.operations[operation](study, **arguments)
+        self.get_studycache().evict()
+
+        if not isinstance(result, pd.DataFrame):
+            return result
+
+        if output_file:
+            result.to_csv(output_file, sep="\t", index=False, encoding='utf-8')
+            return {'output_file': output_file, 'rows': len(result)}
+
+        return json.loads(result.to_json(orient='records'))
+
+    # serve until interrupted
+    def serve(self):
+
+        server = ThreadingServer((self.host, self.port), self.get_handler(), bind_and_activate=False)
+
+        # queue concurrent connections instead of refusing them
+        server.request_queue_size = 128
+        server.server_bind()
+        server.server_activate()
+        print("Serving mzQuality on http://{}:{}/".format(self.host, self.port))
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+    # *************************************
+    # OPERATIONS
+    # *************************************
+
+    def summary(self, study):
+
+        mea = study.get_mea()
+
+        return {
+            'batches': mea.get_batches().tolist(),
+            'samples': mea.get_samples().tolist(),
+            'compounds': mea.get_compounds().tolist()
+        }
+
+    def blank_effect(self, study, by_batch=False):
+        return study.get_result(('blank_effect', by_batch), lambda: study.get_qccalc().blank_effect(by_batch=by_batch))
+
+    def rt_shifts(self, study, column='rt'):
+        return study.get_result(('rt_shifts', column), lambda: study.get_qccalc().rt_shifts(column=column))
+
+    def qc_correction(self, study):
+        return study.get_qc_corrected().get_mea().get_measurements(drop_na=False)
+
+    def qc_rsd(self, study, by_batch=False, bootstrap=0, confidence=0.95, seed=0):
+        return study.get_result(('qc_rsd', by_batch, bootstrap, confidence, seed), lambda: study.get_qc_corrected().rsdqc(
+            by_batch=by_batch, bootstrap=bootstrap, confidence=confidence, seed=seed))
+
+    def rep_rsd(self, study, by_batch=False, bootstrap=0, confidence=0.95, seed=0):
+        return study.get_result(('rep_rsd', by_batch, bootstrap, confidence, seed), lambda: study.get_qc_corrected().rsdrep(
+            by_batch=by_batch, bootstrap=bootstrap, confidence=confidence, seed=seed))
+
+    def internal_standard_rsd(self, study, by_batch=False):
+        return study.get_result(('internal_standard_rsd', by_batch), lambda: study.get_qc_corrected().rsdis(by_batch=by_batch))
+
+    def export(self, study, column='area', include_is=False):
+
+        mea = study.get_qc_corrected().get_mea() if column == 'inter_median_qc_corrected' else study.get_mea()
+
+        return study.get_result(('export', column, include_is), lambda: mea.as_table(column=column, include_is=include_is))
+
+    def plot_compound(self, study, compound, plot_location=''):
+
+        qcplot = Qcplot(mea=study.get_qc_corrected().get_mea())
+
+        with study.lock:
+            return {'plot_file': qcplot.plot_compound_qc_data(compound=compound, location=plot_location)}
+
+    # *************************************
+    # HELPER FUNCTIONS
+    # *************************************
+
+    # get the request handler of the HTTP server
+    def get_handler(self):
+
+        qcserver = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            # GET /status, /clear or /<operation>?mea_file=..., values are JSON (or text)
+            def do_GET(self):
+
+                url = urlparse(self.path)
+                arguments = {name: qcserver.parse_value(value) for name, value in parse_qsl(url.query)}
+                self.respond(url.path.strip('/'), arguments)
+
+            # POST /<operation> with the arguments as JSON object
+            def do_POST(self):
+
+                length = int(self.headers.get('Content-Length', 0))
+                try:
+                    arguments = json.loads(self.rfile.read(length) or b'{}')
+                except ValueError:
+                    return self.send_json(400, {'error': 'The request is not valid JSON'})
+
+                self.respond(urlparse(self.path).path.strip('/'), arguments)
+
+            def respond(self, operation, arguments):
+
+                try:
+                    if operation == 'status':
+                        return self.send_json(200, qcserver.get_studycache().get_status())
+                    if operation == 'clear':
+                        qcserver.get_studycache().clear()
+                        return self.send_json(200, qcserver.get_studycache().get_status())
+
+                    self.send_json(200, qcserver.run(operation, **arguments))
+                except UnknownOperationError as error:
+                    self.send_json(404, {'error': str(error)})
+                except (KeyError, TypeError, ValueError, OSError) as error:
+                    self.send_json(400, {'error': str(error)})
+                except Exception as error:
+                    self.send_json(500, {'error': repr(error)})
+
+            def send_json(self, status, data):
+
+                body = json.dumps(data).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            # requests are not logged
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    # parse a value of a query string as JSON, or keep it as text
+    def parse_value(self, value):
+
+        try:
+            return json.loads(value)
+        except ValueError:
+            return value
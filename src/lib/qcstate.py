@@ -0,0 +1,320 @@
+import os
+import numpy as np
+import pandas as pd
+
+# QC state of a study which is updated one batch at a time
+class Qcstate:
+
+    # columns of the measurements used to update the state
+    columns = ['compound', 'compound_is', 'aliquot', 'batch', 'type', 'area', 'area_is', 'ratio']
+
+    # tables of the state, and their columns
+    tables = {
+        'qc_ratios': ['compound', 'batch', 'ratio'],
+        'qc_stats': ['compound', 'batch', 'qc_median', 'qc_count',
+                     'area_n', 'area_mean', 'area_m2', 'ratio_n', 'ratio_mean', 'ratio_m2'],
+        'is_aliquots': ['internal_standard', 'batch', 'aliquot', 'type', 'area_is'],
+        'is_stats': ['internal_standard', 'batch', 'type', 'area_is_n', 'area_is_mean', 'area_is_m2'],
+        'factors': ['compound', 'batch', 'factor']
+    }
+
+    # columns of the tables which are always text
+    text_columns = ['compound', 'internal_standard', 'aliquot', 'type']
+
+    def __init__(self, state_dir=''):
+
+        # init
+        self.state_dir = None
+        self.state = {table: pd.DataFrame(columns=columns) for table, columns in self.tables.items()}
+        self.stored_rows = {table: 0 for table in self.tables}
+
+        # read in settings when provided
+        if state_dir != '':
+            self.set_state_dir(state_dir)
+            self.read_state()
+
+    # set state directory
+    def set_state_dir(self, state_dir=''):
+        self.state_dir = state_dir
+
+    # get state directory
+    def get_state_dir(self):
+        return self.state_dir
+
+    # get a table of the state
+    def get_table(self, table):
+        return self.state[table]
+
+    # get the batches in the state
+    def get_batches(self):
+        return np.sort(self.get_table('qc_stats')['batch'].unique())
+
+    # get the QC correction factor of each compound and batch
+    def get_correction_factors(self):
+        return self.get_table('factors')
+
+    # get the location of a table of the state
+    def get_table_file(self, table):
+        return os.path.join(self.get_state_dir(), table + '.tsv')
+
+    # read the state from the state directory, missing tables are empty
+    def read_state(self):
+
+        for table, columns in self.tables.items():
+            if os.path.isfile(self.get_table_file(table)):
+                rows = pd.read_csv(self.get_table_file(table), sep="\t", float_precision='round_trip',
+                                   dtype={column: str for column in self.text_columns if column in columns})
+                self.stored_rows[table] = len(rows)
+
+                # changed factors are appended, the last factor of each compound and batch is the current one
+                if table == 'factors':
+                    rows = rows.drop_duplicates(['compound', 'batch'], keep='last')
+                    rows = rows.sort_values(['compound', 'batch']).reset_index(drop=True)
+
+                self.state[table] = rows
+
+    # append rows to a table of the state, optionally replacing the stored table
+    def write_table(self, table, rows, replace=False):
+
+        os.makedirs(self.get_state_dir(), exist_ok=True)
+        table_file = self.get_table_file(table)
+
+        if replace or not os.path.isfile(table_file):
+            self.get_table(table).to_csv(table_file, sep="\t", index=False, encoding='utf-8')
+            self.stored_rows[table] = len(self.get_table(table))
+        else:
+            rows.to_csv(table_file, sep="\t", index=False, header=False, mode='a', encoding='utf-8')
+            self.stored_rows[table] += len(rows)
+
+    # add new batch(es) to the state, only the measurements of the new batch(es) are used
+    def append_batch(self, mea):
+
+        measurements = mea.get_measurements()
+
+        new_batches = np.sort(measurements['batch'].unique())
+        known_batches = set(new_batches) & set(self.get_batches())
+        if known_batches:
+            raise ValueError("Batch(es) {} are already part of the QC state".format(sorted(known_batches)))
+
+        is_aliquots = self.calculate_is_aliquots(measurements)
+        new_rows = {
+            'qc_ratios': self.calculate_qc_ratios(measurements),
+            'qc_stats': self.calculate_qc_stats(measurements),
+            'is_aliquots': is_aliquots,
+            'is_stats': self.calculate_is_stats(is_aliquots)
+        }
+
+        for table, rows in new_rows.items():
+            self.state[table] = self.concat_tables(self.get_table(table), rows)
+
+        # only the factors of compounds measured in the new batch(es) can change
+        compounds = np.asarray(measurements['compound'].unique())
+        factors, changed_factors = self.calculate_factors(compounds)
+        self.state['factors'] = factors
+
+        # store the state, the existing tables are only appended to (the changed factors replace the earlier factors of
+        # their compound and batch when the state is read), the factors are compacted when most stored rows are outdated
+        if self.get_state_dir() is not None:
+            for table, rows in new_rows.items():
+                self.write_table(table, rows)
+
+            if len(changed_factors):
+                compact = self.stored_rows['factors'] + len(changed_factors) > 2 * len(factors)
+                self.write_table('factors', changed_factors, replace=compact)
+
+        return changed_factors
+
+    # QC correction using the correction factors in the state
+    def qc_correction(self, mea):
+
+        measurements = mea.get_measurements(copy=True)
+
+        factors = self.get_correction_factors().set_index(['compound', 'batch'])['factor']
+        keys = pd.MultiIndex.from_arrays([np.asarray(measurements['compound']), measurements['batch'].values])
+        qc_correct_factor = factors.reindex(keys).values
+
+        # add column inter_median_qc_corrected with median corrected ratios
+        measurements['inter_median_qc_corrected'] = measurements['ratio'] * qc_correct_factor
+
+        return measurements
+
+    # RSD's of the QC's, like Qccalc.rsdqc, from the statistics in the state
+    def rsdqc(self, by_batch=False):
+
+        qc_stats = self.get_table('qc_stats').merge(self.get_correction_factors(), on=['compound', 'batch'], how='left')
+
+        # statistics of the QC corrected ratios follow from those of the ratios
+        qc_stats['corrected_n'] = qc_stats['ratio_n']
+        qc_stats['corrected_mean'] = qc_stats['ratio_mean'] * qc_stats['factor']
+        qc_stats['corrected_m2'] = qc_stats['ratio_m2'] * qc_stats['factor'] ** 2
+
+        keys = ['compound', 'batch'] if by_batch else ['compound']
+
+        rsdqc = pd.DataFrame(index=qc_stats.groupby(keys).size().index)
+        rsdqc['rsdqc_nc'] = self.combined_rsd(qc_stats, keys, 'area')
+        rsdqc['rsdqc_is_corrected'] = self.combined_rsd(qc_stats, keys, 'ratio')
+        rsdqc['rsdqc_inter_median_qc_corrected'] = self.combined_rsd(qc_stats, keys, 'corrected')
+
+        return rsdqc.reset_index().round(decimals=2)
+
+    # RSD's of the internal standards, like Qccalc.rsdis, from the statistics in the state (aliquots count once per batch,
+    # or once in the whole study from the first batch with their internal standard)
+    def rsdis(self, by_batch=False):
+
+        if not by_batch:
+            return self.pooled_rsdis()
+
+        is_stats = self.get_table('is_stats')
+
+        keys = ['internal_standard', 'batch'] if by_batch else ['internal_standard']
+
+        rsdis = pd.DataFrame(index=is_stats.groupby(keys).size().index)
+        rsdis['rsdis_samples'] = self.combined_rsd(is_stats[is_stats['type'] == 'sample'], keys, 'area_is')
+        rsdis['rsdis_qc'] = self.combined_rsd(is_stats[is_stats['type'] == 'qc'], keys, 'area_is')
+
+        rsdis = rsdis.reset_index()
+        if by_batch:
+            rsdis = rsdis[['internal_standard', 'rsdis_samples', 'rsdis_qc', 'batch']]
+
+        return rsdis.round(decimals=2)
+
+    # *************************************
+    # HELPER FUNCTIONS
+    # *************************************
+
+    # positive QC ratios, for the inter batch medians
+    def calculate_qc_ratios(self, measurements):
+
+        qc_index = (measurements['type'] == 'qc') & (measurements['ratio'] > 0)
+
+        return pd.DataFrame({
+            'compound': np.asarray(measurements.loc[qc_index, 'compound']),
+            'batch': measurements.loc[qc_index, 'batch'].values,
+            'ratio': measurements.loc[qc_index, 'ratio'].values
+        })
+
+    # count, mean and sum of squared deviations of area and ratio, and the median of the positive ratios, of the QC's
+    def calculate_qc_stats(self, measurements):
+
+        qc = measurements[measurements['type'] == 'qc']
+        qc = pd.DataFrame({
+            'compound': np.asarray(qc['compound']),
+            'batch': qc['batch'].values,
+            'area': qc['area'].values,
+            'ratio': qc['ratio'].values,
+            'positive_ratio': qc['ratio'].where(qc['ratio'] > 0).values
+        })
+
+        grouped = qc.groupby(['compound', 'batch'])
+        qc_stats = grouped.size().rename('qc_count').to_frame()
+        qc_stats['qc_median'] = grouped['positive_ratio'].median()
+
+        for column in ['area', 'ratio']:
+            qc_stats[column + '_n'] = grouped[column].count()
+            qc_stats[column + '_mean'] = grouped[column].mean()
+            qc_stats[column + '_m2'] = grouped[column].var(ddof=0) * qc_stats[column + '_n']
+
+        return qc_stats.reset_index()[self.tables['qc_stats']]
+
+    # type and internal standard area of each aliquot and batch (the first, like Qccalc)
+    def calculate_is_aliquots(self, measurements):
+
+        is_data = pd.DataFrame({
+            'internal_standard': np.asarray(measurements['compound_is']),
+            'batch': measurements['batch'].values,
+            'aliquot': np.asarray(measurements['aliquot']),
+            'type': np.asarray(measurements['type']),
+            'area_is': measurements['area_is'].values
+        })
+
+        return is_data.groupby(['internal_standard', 'batch', 'aliquot']).first().reset_index()[self.tables['is_aliquots']]
+
+    # count, mean and sum of squared deviations of the internal standard area (once per aliquot)
+    def calculate_is_stats(self, is_aliquots):
+
+        grouped = is_aliquots.groupby(['internal_standard', 'batch', 'type'])['area_is']
+        is_stats = grouped.count().rename('area_is_n').to_frame()
+        is_stats['area_is_mean'] = grouped.mean()
+        is_stats['area_is_m2'] = grouped.var(ddof=0) * is_stats['area_is_n']
+
+        return is_stats.reset_index()[self.tables['is_stats']]
+
+    # recalculate the correction factors of compounds, returns all factors and the ones which changed
+    def calculate_factors(self, compounds):
+
+        qc_ratios = self.get_table('qc_ratios')
+        qc_ratios = qc_ratios[qc_ratios['compound'].isin(compounds)]
+
+        # inter batch qc ratio median
+        compound_qc_ratio_medians = qc_ratios.groupby('compound')['ratio'].median()
+
+        qc_stats = self.get_table('qc_stats')
+        qc_stats = qc_stats[qc_stats['compound'].isin(compounds)]
+
+        # use median to level/scale ratio
+        new_factors = pd.DataFrame({
+            'compound': qc_stats['compound'].values,
+            'batch': qc_stats['batch'].values,
+            'factor': compound_qc_ratio_medians.reindex(qc_stats['compound']).values / qc_stats['qc_median'].values
+        })
+
+        factors = self.get_correction_factors()
+        compared = new_factors.merge(factors, on=['compound', 'batch'], how='left', suffixes=('', '_old'), indicator=True)
+        unchanged = (compared['_merge'] == 'both') & (
+            (compared['factor'] == compared['factor_old']) |
+            (compared['factor'].isnull() & compared['factor_old'].isnull()))
+        changed_factors = new_factors[~unchanged.values].reset_index(drop=True)
+
+        factors = self.concat_tables(factors[~factors['compound'].isin(compounds)], new_factors)
+        factors = factors.sort_values(['compound', 'batch']).reset_index(drop=True)
+
+        return factors, changed_factors
+
+    # RSD's of the internal standards over all batches, each aliquot counts once (with its first internal standard area)
+    def pooled_rsdis(self):
+
+        is_aliquots = self.get_table('is_aliquots').sort_values('batch', kind='mergesort')
+        is_aliquots = is_aliquots.groupby(['internal_standard', 'aliquot']).first()
+
+        grouped = is_aliquots.groupby(['internal_standard', 'type'])['area_is']
+        rsd = (100 * grouped.std() / grouped.mean()).unstack('type').reindex(columns=['sample', 'qc'])
+
+        rsdis = pd.DataFrame({
+            'internal_standard': rsd.index.values,
+            'rsdis_samples': rsd['sample'].values,
+            'rsdis_qc': rsd['qc'].values
+        })
+
+        return rsdis.round(decimals=2)
+
+    # RSD of the groups combined by keys, from their count, mean and sum of squared deviations
+    def combined_rsd(self, stats, keys, column):
+
+        stats = stats[(stats[column + '_n'] > 0) & stats[column + '_mean'].notnull()]
+        groups = [stats[key] for key in keys]
+
+        n = stats[column + '_n']
+        mean = stats[column + '_mean']
+        total_n = n.groupby(groups).transform('sum')
+        total_mean = (n * mean).groupby(groups).transform('sum') / total_n
+
+        # sum of squared deviations within and between the groups
+        m2 = stats[column + '_m2'] + n * (mean - total_mean) ** 2
+
+        combined_n = n.groupby(groups).sum()
+        combined_mean = total_mean.groupby(groups).first()
+        combined_m2 = m2.groupby(groups).sum()
+
+        std = np.sqrt(combined_m2 / (combined_n - 1).where(combined_n > 1))
+
+        return 100 * (std / combined_mean)
+
+    # concatenate the rows of two tables, keeping the column types when one is still empty
+    def concat_tables(self, table, rows):
+
+        if not len(table):
+            return rows.reset_index(drop=True)
+        if not len(rows):
+            return table.reset_index(drop=True)
+
+        return pd.concat([table, rows], ignore_index=True)
@@ -0,0 +1,225 @@
+import os
+import glob
+import json
+import time
+import shutil
+import hashlib
+import threading
+from .mea import Mea
+
+# on disk cache of the output files of commands, keyed on the content of the input files, the command, its parameters
+# and the version (source code) of the tool, limited in size by removing the least recently used results
+class Resultcache:
+
+    # file with the description of a cached result, next to its output files
+    entry_file = 'entry.json'
+
+    # file with the content hashes of the input files, by path, size and modification time
+    fingerprints_file = 'fingerprints.json'
+
+    def __init__(self, cache_dir, size_limit=1024, sources=()):
+
+        # init
+        self.cache_dir = cache_dir
+        self.size_limit = int(size_limit * 1024 ** 2)  # in MB
+        self.sources = list(sources)  # source files of the tool besides the library
+        self.version = None
+        self.lock = threading.Lock()
+
+    # get the cache directory
+    def get_cache_dir(self):
+        return self.cache_dir
+
+    # get the version of the tool, the hash of its source code (a changed tool does not use older results)
+    def get_version(self):
+
+        if self.version is None:
+            sha1 = hashlib.sha1()
+            for source in sorted(glob.glob(os.path.join(os.path.dirname(__file__), '*.py'))) + self.sources:
+                with open(source, 'rb') as f:
+                    sha1.update(f.read())
+            self.version = sha1.hexdigest()
+
+        return self.version
+
+    # get the key of the result of a command on input files with parameters
+    def get_key(self, command, input_files, parameters):
+
+        key = {
+            'command': command,
+            'inputs': [self.get_fingerprint(input_file) for input_file in input_files],
+            'parameters': parameters,
+            'version': self.get_version()
+        }
+
+        return hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    # copy the cached output files of a result to their locations (by name), returns False when it is not cached
+    def get(self, key, outputs):
+
+        entry = self.read_entry(key)
+        if entry is None or not entry['outputs'] or sorted(entry['outputs']) != sorted(outputs):
+            return False
+
+        # a result with missing output files (partly removed or edited) is removed, it is calculated again
+        entry_dir = self.get_entry_dir(key)
+        if not all(os.path.isfile(os.path.join(entry_dir, name)) for name in outputs):
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            return False
+
+        for name, location in outputs.items():
+            directory = os.path.dirname(location)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            try:
+                shutil.copyfile(os.path.join(entry_dir, name), location)
+            except FileNotFoundError:
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                return False
+
+        # used now
+        entry['last_used'] = time.time()
+        entry['hits'] += 1
+        self.write_entry(key, entry)
+
+        return True
+
+    # store the output files (by name) of a result, a result without output files is not stored
+    def put(self, key, outputs, command='', input_files=(), parameters=None):
+
+        if not outputs:
+            return False
+
+        entry_dir = self.get_entry_dir(key)
+        tmp_dir = "{}.{}.tmp".format(entry_dir, os.getpid())
+
+        os.makedirs(tmp_dir, exist_ok=True)
+        for name, location in outputs.items():
+            shutil.copyfile(location, os.path.join(tmp_dir, name))
+
+        entry = {
+            'key': key,
+            'command': command,
+            'inputs': [os.path.abspath(input_file) for input_file in input_files],
+            'parameters': parameters or {},
+            'outputs': sorted(outputs),
+            'size': sum(os.path.getsize(os.path.join(tmp_dir, name)) for name in outputs),
+            'created': time.time(),
+            'last_used': time.time(),
+            'hits': 0
+        }
+        with open(os.path.join(tmp_dir, self.entry_file), 'w') as f:
+            json.dump(entry, f)
+
+        # replace a result of the same key
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.replace(tmp_dir, entry_dir)
+
+        self.evict()
+
+        return True
+
+    # get the cached results, least recently used first
+    def get_entries(self):
+
+        entries = []
+        for entry_file in glob.glob(os.path.join(self.get_cache_dir(), 'results', '*', self.entry_file)):
+            entry = self.read_entry(os.path.basename(os.path.dirname(entry_file)))
+            if entry is not None:
+                entries.append(entry)
+
+        return sorted(entries, key=lambda entry: entry['last_used'])
+
+    # get the status of the cache
+    def get_status(self):
+
+        entries = self.get_entries()
+
+        return {
+            'cache_dir': os.path.abspath(self.get_cache_dir()),
+            'version': self.get_version(),
+            'results': len(entries),
+            'size': sum(entry['size'] for entry in entries),
+            'size_limit': self.size_limit,
+            'hits': sum(entry['hits'] for entry in entries)
+        }
+
+    # remove the least recently used results until the cache fits in its size limit (the last result is kept)
+    def evict(self):
+
+        entries = self.get_entries()
+        size = sum(entry['size'] for entry in entries)
+
+        removed = 0
+        while len(entries) > 1 and size > self.size_limit:
+            entry = entries.pop(0)
+            shutil.rmtree(self.get_entry_dir(entry['key']), ignore_errors=True)
+            size -= entry['size']
+            removed += 1
+
+        return removed
+
+    # remove all results, or those of a command
+    def purge(self, command=''):
+
+        removed = 0
+        for entry in self.get_entries():
+            if not command or entry['command'] == command:
+                shutil.rmtree(self.get_entry_dir(entry['key']), ignore_errors=True)
+                removed += 1
+
+        return removed
+
+    # *************************************
+    # HELPER FUNCTIONS
+    # *************************************
+
+    # get the directory of a result
+    def get_entry_dir(self, key):
+        return os.path.join(self.get_cache_dir(), 'results', key)
+
+    # read the description of a result, None when it is not (completely) cached
+    def read_entry(self, key):
+
+        try:
+            with open(os.path.join(self.get_entry_dir(key), self.entry_file)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    # write the description of a result (replaced atomically)
+    def write_entry(self, key, entry):
+
+        entry_file = os.path.join(self.get_entry_dir(key), self.entry_file)
+        entry_tmp_file = "{}.{}.tmp".format(entry_file, os.getpid())
+
+        with open(entry_tmp_file, 'w') as f:
+            json.dump(entry, f)
+        os.replace(entry_tmp_file, entry_file)
+
+    # get the content hash of an input file, hashed again only when its size or modification time changed
+    def get_fingerprint(self, input_file):
+
+        fingerprints_file = os.path.join(self.get_cache_dir(), self.fingerprints_file)
+        file_key = Mea().get_file_key(input_file, content=False)
+
+        with self.lock:
+            try:
+                with open(fingerprints_file) as f:
+                    fingerprints = json.load(f)
+            except (OSError, ValueError):
+                fingerprints = {}
+
+            fingerprint = fingerprints.get(file_key['path'])
+            if fingerprint is not None and all(fingerprint[key] == file_key[key] for key in file_key):
+                return fingerprint['sha1']
+
+            fingerprints[file_key['path']] = Mea().get_file_key(input_file)
+
+            os.makedirs(self.get_cache_dir(), exist_ok=True)
+            fingerprints_tmp_file = "{}.{}.tmp".format(fingerprints_file, os.getpid())
+            with open(fingerprints_tmp_file, 'w') as f:
+                json.dump(fingerprints, f)
+            os.replace(fingerprints_tmp_file, fingerprints_file)
+
+        return fingerprints[file_key['path']]['sha1']
@@ -0,0 +1,158 @@
+import sys
+import time
+import collections
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+# runs the stages of a workflow in a pool of threads as soon as the stages they depend on are done, the results of
+# stages are written by background writer threads so computing and writing overlap
+class Scheduler:
+
+    def __init__(self, workers=4, writers=2):
+
+        # init
+        self.workers = max(1, workers)
+        self.writers = max(1, writers)
+        self.stages = collections.OrderedDict()
+        self.results = {}
+        self.records = collections.OrderedDict()
+        self.start = None
+        self.wall = None
+
+    # add a stage, its function is called with the results of its dependencies (in order), a stage is skipped when
+    # a dependency has no result (None). When given, write is called with the result by a writer thread
+    def add_stage(self, name, function, dependencies=(), write=None):
+
+        if name in self.stages:
+            raise ValueError("Stage '{}' is already added".format(name))
+
+        for dependency in dependencies:
+            if dependency not in self.stages:
+                raise KeyError("Stage '{}' depends on unknown stage '{}'".format(name, dependency))
+
+        self.stages[name] = {'function': function, 'dependencies': list(dependencies), 'write': write}
+
+    # get the result of a stage
+    def get_result(self, name):
+        return self.results.get(name)
+
+    # run all stages, the first error (of a stage or a write) is raised when the running stages are done
+    def run(self):
+
+        self.start = time.perf_counter()
+        pending = collections.OrderedDict(self.stages)
+        running = {}
+        writing = []
+        error = None
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor, \
+                ThreadPoolExecutor(max_workers=self.writers) as writer:
+
+            while pending or running:
+
+                # start the stages of which all dependencies are done
+                if error is None:
+                    for name in [name for name, stage in pending.items()
+                                 if all(dependency in self.results for dependency in stage['dependencies'])]:
+                        stage = pending.pop(name)
+                        arguments = [self.results[dependency] for dependency in stage['dependencies']]
+
+                        if any(argument is None for argument in arguments):
+                            self.results[name] = None
+                        else:
+                            running[executor.submit(self.run_stage, name, stage['function'], arguments)] = name
+                else:
+                    pending.clear()
+
+                if not running:
+                    continue
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        self.results[name] = future.result()
+                    except Exception as stage_error:
+                        error = error or stage_error
+                        continue
+
+                    write = self.stages[name]['write']
+                    if write is not None and self.results[name] is not None:
+                        writing.append(writer.submit(self.run_write, name, write, self.results[name]))
+
+            for future in writing:
+                try:
+                    future.result()
+                except Exception as write_error:
+                    error = error or write_error
+
+        self.wall = time.perf_counter() - self.start
+
+        if error is not None:
+            raise error
+
+        return self.results
+
+    # get the seconds of each stage (and of each write, as write_<stage>)
+    def get_timings(self):
+        return {name: round(record['end'] - record['start'], 3) for name, record in self.records.items()}
+
+    # get the longest chain of stages (and a final write) by their seconds, which sets the least time of a run
+    def get_critical_path(self):
+
+        # the latest finishing chain to each stage and write, in order of dependencies
+        chains = {}
+        for name, stage in self.stages.items():
+            if name not in self.records:
+                continue
+
+            previous = [chains[dependency] for dependency in stage['dependencies'] if dependency in chains]
+            chain = max(previous, key=lambda chain: chain[0], default=(0, []))
+            seconds = self.records[name]['end'] - self.records[name]['start']
+            chains[name] = (chain[0] + seconds, chain[1] + [(name, seconds)])
+
+            if 'write_' + name in self.records:
+                record = self.records['write_' + name]
+                chains['write_' + name] = (chains[name][0] + record['end'] - record['start'],
+                                           chains[name][1] + [('write_' + name, record['end'] - record['start'])])
+
+        seconds, path = max(chains.values(), key=lambda chain: chain[0], default=(0, []))
+
+        return {'seconds': round(seconds, 3), 'stages': [{'stage': name, 'seconds': round(stage_seconds, 3)} for name, stage_seconds in path]}
+
+    # get the timing report: wall time of the run, the summed time of all stages and writes, and the critical path
+    def get_report(self):
+
+        return {
+            'wall': None if self.wall is None else round(self.wall, 3),
+            'serial': round(sum(record['end'] - record['start'] for record in self.records.values()), 3),
+            'critical_path': self.get_critical_path(),
+            'stages': [
+                {'stage': name, 'start': round(record['start'], 3), 'end': round(record['end'], 3)}
+                for name, record in sorted(self.records.items(), key=lambda item: item[1]['start'])
+            ]
+        }
+
+    # *************************************
+    # HELPER FUNCTIONS
+    # *************************************
+
+    # run the function of a stage, recording its start and end (relative to the start of the run)
+    def run_stage(self, name, function, arguments):
+
+        start = time.perf_counter() - self.start
+        result = function(*arguments)
+        self.records[name] = {'start': start, 'end': time.perf_counter() - self.start}
+
+        # to stderr, stdout holds the result of a command
+        print(" - {} done in {:.2f}s".format(name, self.records[name]['end'] - start), file=sys.stderr)
+
+        return result
+
+    # write the result of a stage, recording its start and end
+    def run_write(self, name, write, result):
+
+        start = time.perf_counter() - self.start
+        write(result)
+        self.records['write_' + name] = {'start': start, 'end': time.perf_counter() - self.start}
+
+        return True
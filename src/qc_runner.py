@@ -26,7 +26,7 @@ if True:
 
 # do qc correction
 if True:
-    qc_corrected = qccalc.qc_correction()
+    qc_corrected = qccalc.qc_correction(drift=True)
     qc_corrected.to_csv(base_folder + 'qc_corrected.tsv', sep="\t", index=False, encoding='utf-8')
     print("QC Corrected data reported")
 